@@ -46,8 +46,16 @@ class UserAccount(object):
     #     return self.services[attr]
 
     def set_cache_dir(self, cache_dir):
+        self.set_caches(dict(
+                (n, Cache(os.path.join(cache_dir, n))) for n in self.services))
+
+    def set_caches(self, caches):
+        """ Sets the cache of each service, from a dictionary of caches
+            by service name. Each service needs its own cache, since
+            they use the same keys for different things.
+        """
         for n, s in self.services.iteritems():
-            s.cache = Cache(os.path.join(cache_dir, n))
+            s.set_cache(caches[n])
 
     def get_collections(self):
         for n, s in self.services.iteritems():
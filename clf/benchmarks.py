@@ -0,0 +1,270 @@
+import sys
+import time
+import shutil
+import random
+import tempfile
+import datetime
+from cache import Cache, DEFAULT_COMPRESS_THRESHOLD
+from comic import Collection, Series, Volume, Issue
+from comixology import ComixologyIssueMetadata, IssuePage
+
+
+def make_synthetic_collection(issue_count, pages_per_issue=24, seed=0):
+    """ Builds fake service responses for a collection of the given
+        size: a Dark Horse style `collection/brands` tree, and one
+        Comixology style `getUserPurchase` response per issue.
+    """
+    rnd = random.Random(seed)
+    brand = {'name': 'Synthetic Comics', 'series': []}
+    issues = {}
+    issues_per_series = 25
+    series_count = max(1, issue_count // issues_per_series)
+    comic_id = 0
+    for s in range(series_count):
+        series = {
+                'uuid': 'series-%06d' % s,
+                'name': 'Synthetic Series %d' % s,
+                'cover_image': 'https://cdn.example.com/series/%06d/cover.jpg' % s,
+                'volumes': []
+                }
+        volume = {
+                'uuid': 'volume-%06d' % s,
+                'name': 'Synthetic Series %d' % s,
+                'sort_key': 'volume_%d' % s,
+                'cover_image': 'https://cdn.example.com/volumes/%06d/cover.jpg' % s,
+                'books': []
+                }
+        series['volumes'].append(volume)
+        brand['series'].append(series)
+        for i in range(issues_per_series):
+            if comic_id >= issue_count:
+                break
+            volume['books'].append({
+                    'book_uuid': 'book-%06d' % comic_id,
+                    'volume_uuid': volume['uuid'],
+                    'series_uuid': series['uuid'],
+                    'sort_key': 'book_%d' % i,
+                    'title': '%s #%d' % (series['name'], i + 1),
+                    'cover_image': 'https://cdn.example.com/books/%06d/cover.jpg' % comic_id,
+                    'more_info_url': 'https://www.example.com/books/%06d' % comic_id,
+                    'price': rnd.choice([0.99, 1.99, 2.99, 3.99])
+                    })
+            issues['get_issue_%d' % comic_id] = _make_purchase(rnd, comic_id, pages_per_issue)
+            comic_id += 1
+    return ([brand], issues)
+
+
+def _make_purchase(rnd, comic_id, page_count):
+    pages = []
+    for p in range(page_count):
+        url = 'https://cdn.example.com/books/%06d/pages/%04d.jpg?token=%032x' % (
+                comic_id, p, rnd.getrandbits(128))
+        pages.append({'descriptor_set': {'image_descriptors': [
+                {'uri': url + '&thumb=1', 'pixel_width': '160', 'pixel_height': '240',
+                    'expected_content_length': str(rnd.randint(5000, 9000))},
+                {'uri': url, 'pixel_width': '1988', 'pixel_height': '3056',
+                    'expected_content_length': str(rnd.randint(400000, 900000))}
+                ]}})
+    return {
+            'version': str(rnd.randint(1, 5)),
+            'issue_info': {
+                'synopsis': ('A synthetic synopsis for issue %d. ' % comic_id) * 8,
+                'publisher': {'name': 'Synthetic Comics'},
+                'series': {'issue_num': str(comic_id)}
+                },
+            'book_info': {'pages': pages}
+            }
+
+
+def bench_cache_compression(issue_count=5000, backend='sqlite'):
+    """ Writes a synthetic collection to a disk cache with and without
+        payload compression, and measures the write time, the disk
+        footprint, and the time it takes to load everything back.
+    """
+    collection, issues = make_synthetic_collection(issue_count)
+    results = []
+    for label, threshold in [('plain', None), ('compressed', DEFAULT_COMPRESS_THRESHOLD)]:
+        cache_dir = tempfile.mkdtemp(prefix='clf-bench-')
+        try:
+            lifetime = datetime.timedelta(days=1)
+            cache = Cache(cache_dir, backend=backend, compress_threshold=threshold)
+            start = time.time()
+            cache.set('get_collection', collection, lifetime)
+            for key, item in issues.iteritems():
+                cache.set(key, item, lifetime)
+            cache.flush()
+            write_time = time.time() - start
+            disk_size = cache.get_disk_usage()['size']
+            cache.store.close()
+
+            # Load everything back with a cold memory tier.
+            cache = Cache(cache_dir, backend=backend, compress_threshold=threshold)
+            start = time.time()
+            cache.get('get_collection')
+            for key in issues.iterkeys():
+                cache.get(key)
+            load_time = time.time() - start
+            cache.store.close()
+
+            results.append({
+                    'label': label,
+                    'write_time': write_time,
+                    'load_time': load_time,
+                    'disk_size': disk_size
+                    })
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+
+class _DictObject(object):
+    # Stands for the dict-backed model objects used before the model
+    # got slots.
+    pass
+
+
+def bench_model_memory(issue_count=50000, pages_per_issue=20):
+    """ Builds a synthetic collection, with page information for every
+        issue, using the compact model and an equivalent dict-backed
+        one, and measures the memory taken by each.
+    """
+    results = []
+    for label, build in [('dict', _build_dict_model), ('slots', _build_compact_model)]:
+        start = time.time()
+        collection = build(issue_count, pages_per_issue)
+        build_time = time.time() - start
+        results.append({
+                'label': label,
+                'build_time': build_time,
+                'size': _get_deep_size(collection)
+                })
+        del collection
+    return results
+
+
+def _iter_synthetic_issues(issue_count, pages_per_issue, issues_per_series=25):
+    rnd = random.Random(0)
+    for comic_id in xrange(issue_count):
+        pages = []
+        for p in xrange(pages_per_issue):
+            url = u'https://cdn.example.com/books/%06d/pages/%04d.jpg?token=%032x' % (
+                    comic_id, p, rnd.getrandbits(128))
+            pages.append((url + u'&thumb=1', url, 1988, 3056, rnd.randint(400000, 900000)))
+        yield (comic_id // issues_per_series, comic_id, pages)
+
+
+def _build_dict_model(issue_count, pages_per_issue):
+    collection = _DictObject()
+    collection.series = []
+    vol = None
+    for series_id, comic_id, pages in _iter_synthetic_issues(issue_count, pages_per_issue):
+        if vol is None or vol.volume_id != series_id:
+            series = _DictObject()
+            series.title = u'Synthetic Series %d' % series_id
+            series.series_id = unicode(series_id)
+            series.logo_url = u'https://cdn.example.com/series/%06d/logo.jpg' % series_id
+            series.parent = collection
+            series.volumes = []
+            collection.series.append(series)
+            vol = _DictObject()
+            vol.title = series.title
+            vol.volume_id = series_id
+            vol.volume_num = None
+            vol.logo_url = series.logo_url
+            vol.is_transparent = True
+            vol.parent = series
+            vol._issues = []
+            vol._issues_loader = None
+            vol._preview_issue_count = None
+            series.volumes.append(vol)
+        issue = _DictObject()
+        issue.title = vol.title
+        issue.comic_id = unicode(comic_id)
+        issue.num = unicode(comic_id % 25 + 1)
+        issue.cover_url = u'https://cdn.example.com/books/%06d/cover.jpg' % comic_id
+        issue.url = u'https://www.example.com/books/%06d' % comic_id
+        issue.price = 1.99
+        issue.parent = vol
+        issue._metadata_loader = None
+        metadata = _DictObject()
+        metadata.is_volume_tpb = False
+        metadata.version = u'1'
+        metadata.publisher = u'Synthetic Comics'
+        metadata.imprint = u'Synthetic Comics'
+        metadata.synopsis = None
+        metadata.print_publish_date = None
+        metadata.creators = {}
+        metadata.parent = issue
+        metadata.pages = []
+        for thumbnail_url, url, width, height, size in pages:
+            p = _DictObject()
+            p.thumbnail_url = thumbnail_url
+            p.url = url
+            p.width = width
+            p.height = height
+            p.size = size
+            metadata.pages.append(p)
+        issue._metadata = metadata
+        vol._issues.append(issue)
+    return collection
+
+
+def _build_compact_model(issue_count, pages_per_issue):
+    collection = Collection()
+    vol = None
+    for series_id, comic_id, pages in _iter_synthetic_issues(issue_count, pages_per_issue):
+        if vol is None or vol.volume_id != series_id:
+            series = Series(u'Synthetic Series %d' % series_id)
+            series.series_id = unicode(series_id)
+            series.logo_url = u'https://cdn.example.com/series/%06d/logo.jpg' % series_id
+            collection.series.append(series)
+            vol = Volume(series.title)
+            vol.volume_id = series_id
+            vol.logo_url = series.logo_url
+            vol.is_transparent = True
+            series.volumes.append(vol)
+        issue = Issue(vol.title)
+        issue.comic_id = unicode(comic_id)
+        issue.num = unicode(comic_id % 25 + 1)
+        issue.cover_url = u'https://cdn.example.com/books/%06d/cover.jpg' % comic_id
+        issue.url = u'https://www.example.com/books/%06d' % comic_id
+        issue.price = 1.99
+        metadata = ComixologyIssueMetadata()
+        metadata.version = u'1'
+        metadata.publisher = u'Synthetic Comics'
+        metadata.imprint = u'Synthetic Comics'
+        for thumbnail_url, url, width, height, size in pages:
+            p = IssuePage()
+            p.thumbnail_url = thumbnail_url
+            p.url = url
+            p.width = width
+            p.height = height
+            p.size = size
+            metadata.pages.append(p)
+        issue.set_metadata(metadata)
+        vol.issues.append(issue)
+    return collection
+
+
+def _get_deep_size(root):
+    seen = set()
+    size = 0
+    todo = [root]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            todo.extend(obj.iterkeys())
+            todo.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set)):
+            todo.extend(obj)
+        if hasattr(obj, '__dict__'):
+            todo.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    todo.append(getattr(obj, name))
+    return size
@@ -1,27 +1,533 @@
 import os
+import sys
 import os.path
 import json
 import time
+import zlib
 import datetime
+import atexit
+import sqlite3
 import logging
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_MEMORY_BUDGET = 32 * 1024 * 1024
+DEFAULT_BACKEND = 'sqlite'
+SQLITE_STORE_NAME = 'cache.sqlite'
+# Payloads at least this big are stored compressed.
+DEFAULT_COMPRESS_THRESHOLD = 4 * 1024
+COMPRESS_LEVEL = 6
+# Header of compressed payloads. JSON payloads can't start with it, so
+# entries written before compression existed still load.
+COMPRESSED_PAYLOAD_MAGIC = 'CLFZ1\n'
+
+# Returned by fetchers when a conditional request says the cached data
+# is still current.
+NOT_MODIFIED = object()
+
+
+def _get_expiry_time(item):
+    # Stale entries are kept around until they can't be served anymore.
+    return item.get('stale_time', item['end_time'])
+
+
+def encode_payload(data, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        return COMPRESSED_PAYLOAD_MAGIC + zlib.compress(data, COMPRESS_LEVEL)
+    return data
+
+
+def decode_payload(payload):
+    if payload.startswith(COMPRESSED_PAYLOAD_MAGIC):
+        return zlib.decompress(payload[len(COMPRESSED_PAYLOAD_MAGIC):])
+    return payload
+
+
+def _load_item(payload):
+    return json.loads(decode_payload(payload))
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls for the same key, so that only the
+        first caller does the work and the others wait for its result.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.calls += 1
+                is_leader = True
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                    'calls': self.calls,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self._flights)
+                    }
+
+
+class MemoryTier(object):
+    """ A thread-safe LRU store that keeps the approximate size of its
+        items under a byte budget.
+        `on_remove(key)` is called when an item is evicted, popped or
+        cleared, but not when it's replaced by a newer one.
+    """
+    def __init__(self, budget=DEFAULT_MEMORY_BUDGET, on_remove=None):
+        self.budget = budget
+        self.on_remove = on_remove
+        self.size = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is None:
+                return None
+            self._items[key] = entry
+            return entry[0]
+
+    def put(self, key, item, size):
+        removed = []
+        with self._lock:
+            self._remove(key)
+            if size > self.budget:
+                removed.append(key)
+            else:
+                self._items[key] = (item, size)
+                self.size += size
+            while self.size > self.budget:
+                old_key, old_entry = self._items.popitem(last=False)
+                self.size -= old_entry[1]
+                self.evictions += 1
+                removed.append(old_key)
+                self.logger.debug('Evicted from memory cache: %s' % old_key)
+        self._notify_removed(removed)
+
+    def pop(self, key):
+        with self._lock:
+            self._remove(key)
+        self._notify_removed([key])
+
+    def clear(self):
+        with self._lock:
+            removed = self._items.keys()
+            self._items.clear()
+            self.size = 0
+        self._notify_removed(removed)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                    'items': len(self._items),
+                    'size': self.size,
+                    'budget': self.budget,
+                    'evictions': self.evictions
+                    }
+
+    def _remove(self, key):
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def _notify_removed(self, keys):
+        # Outside of the lock, so the callback can use this store.
+        if self.on_remove is not None:
+            for key in keys:
+                self.on_remove(key)
+
+
+class JsonFileStore(object):
+    """ Disk store that keeps each entry in its own JSON file.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def has(self, key):
+        return os.path.isfile(self._get_path(key))
+
+    def load(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        except IOError:
+            return None
+        self.touch(key)
+        return payload
+
+    def touch(self, key):
+        # The modification time doubles as the last access time.
+        try:
+            os.utime(self._get_path(key), None)
+        except OSError:
+            pass
+
+    def store(self, key, payload, end_time):
+        with open(self._get_path(key), 'wb') as f:
+            f.write(payload)
+
+    def delete(self, key):
+        path = self._get_path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def keys(self):
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith('.json'):
+                yield fn[:-len('.json')]
+
+    def get_usage(self, now):
+        usage = {'entries': 0, 'size': 0, 'expired': 0}
+        for key, path, st in self._iter_files():
+            usage['entries'] += 1
+            usage['size'] += st.st_size
+            if self._get_end_time(path) < now:
+                usage['expired'] += 1
+        return usage
+
+    def delete_expired(self, now):
+        deleted = []
+        for key, path, st in self._iter_files():
+            if self._get_end_time(path) < now:
+                os.remove(path)
+                deleted.append((key, st.st_size))
+        return deleted
+
+    def evict(self, quota):
+        files = sorted(self._iter_files(), key=lambda f: f[2].st_mtime)
+        total = sum(f[2].st_size for f in files)
+        deleted = []
+        for key, path, st in files:
+            if total <= quota:
+                break
+            os.remove(path)
+            total -= st.st_size
+            deleted.append((key, st.st_size))
+        return deleted
+
+    def flush(self):
+        pass
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _iter_files(self):
+        for key in list(self.keys()):
+            path = self._get_path(key)
+            try:
+                yield (key, path, os.stat(path))
+            except OSError:
+                continue
+
+    def _get_end_time(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return _get_expiry_time(_load_item(f.read()))
+        except (IOError, ValueError, KeyError, zlib.error):
+            # Unreadable entries are as good as expired.
+            return 0
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % key)
+
+
+class SqliteStore(object):
+    """ Disk store that keeps all entries in a single SQLite database.
+        Writes are batched and committed in a single transaction.
+    """
+    def __init__(self, db_path, batch_size=32):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._pending = OrderedDict()
+        self._accessed = {}
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def has(self, key):
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key] is not None
+            row = self._get_conn().execute(
+                    'SELECT 1 FROM entries WHERE key=?', (key,)).fetchone()
+            return row is not None
+
+    def load(self, key):
+        with self._lock:
+            if key in self._pending:
+                pending = self._pending[key]
+                if pending is None:
+                    return None
+                return pending[0]
+            row = self._get_conn().execute(
+                    'SELECT payload FROM entries WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._accessed[key] = time.time()
+        return str(row[0])
+
+    def touch(self, key):
+        with self._lock:
+            self._accessed[key] = time.time()
+
+    def store(self, key, payload, end_time):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._pending[key] = (payload, end_time, time.time())
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def delete(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+            # `None` marks a pending deletion.
+            self._pending[key] = None
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def keys(self):
+        with self._lock:
+            self.flush()
+            rows = self._get_conn().execute('SELECT key FROM entries').fetchall()
+        return [r[0] for r in rows]
+
+    def get_usage(self, now):
+        with self._lock:
+            self.flush()
+            row = self._get_conn().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0), '
+                    'COALESCE(SUM(end_time < ?), 0) FROM entries', (now,)).fetchone()
+        return {'entries': row[0], 'size': row[1], 'expired': row[2]}
+
+    def delete_expired(self, now):
+        with self._lock:
+            self.flush()
+            with self._get_conn() as conn:
+                deleted = conn.execute(
+                        'SELECT key, LENGTH(payload) FROM entries WHERE end_time < ?',
+                        (now,)).fetchall()
+                conn.execute('DELETE FROM entries WHERE end_time < ?', (now,))
+        return deleted
+
+    def evict(self, quota):
+        with self._lock:
+            self.flush()
+            with self._get_conn() as conn:
+                total = conn.execute(
+                        'SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM entries').fetchone()[0]
+                deleted = []
+                if total > quota:
+                    rows = conn.execute(
+                            'SELECT key, LENGTH(payload) FROM entries ORDER BY last_access').fetchall()
+                    for key, size in rows:
+                        if total <= quota:
+                            break
+                        deleted.append((key, size))
+                        total -= size
+                    conn.executemany(
+                            'DELETE FROM entries WHERE key=?',
+                            [(key,) for key, size in deleted])
+        return deleted
+
+    def flush(self):
+        with self._lock:
+            if not self._pending and not self._accessed:
+                return
+            with self._get_conn() as conn:
+                for key, pending in self._pending.iteritems():
+                    if pending is None:
+                        conn.execute('DELETE FROM entries WHERE key=?', (key,))
+                    else:
+                        conn.execute(
+                                'INSERT OR REPLACE INTO entries (key, end_time, payload, last_access) '
+                                'VALUES (?, ?, ?, ?)',
+                                (key, pending[1], sqlite3.Binary(pending[0]), pending[2]))
+                conn.executemany(
+                        'UPDATE entries SET last_access=? WHERE key=?',
+                        [(t, k) for k, t in self._accessed.iteritems()])
+            self._pending.clear()
+            self._accessed.clear()
+
+    def compact(self):
+        with self._lock:
+            self.flush()
+            self._get_conn().execute('VACUUM')
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _get_conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                        'CREATE TABLE IF NOT EXISTS entries ('
+                        'key TEXT PRIMARY KEY, end_time REAL, payload BLOB, last_access REAL)')
+                columns = [r[1] for r in self._conn.execute('PRAGMA table_info(entries)')]
+                if 'last_access' not in columns:
+                    self._conn.execute('ALTER TABLE entries ADD COLUMN last_access REAL')
+                self._conn.execute(
+                        'CREATE INDEX IF NOT EXISTS entries_end_time ON entries (end_time)')
+        return self._conn
+
+
+def get_store_backends(cache_dir):
+    """ Gets the backends that have entries stored in the given directory.
+    """
+    backends = []
+    if os.path.isfile(os.path.join(cache_dir, SQLITE_STORE_NAME)):
+        backends.append('sqlite')
+    if os.path.isdir(cache_dir) and any(JsonFileStore(cache_dir).keys()):
+        backends.append('json')
+    return backends
+
+
+def create_store(cache_dir, backend=DEFAULT_BACKEND):
+    if backend == 'sqlite' and get_store_backends(cache_dir) == ['json']:
+        # Don't hide a cache that hasn't been migrated yet behind an
+        # empty database.
+        logging.getLogger(__name__).info(
+                "Using the JSON cache in '%s' until it's migrated." % cache_dir)
+        backend = 'json'
+    if backend == 'json':
+        return JsonFileStore(cache_dir)
+    if backend == 'sqlite':
+        store = SqliteStore(os.path.join(cache_dir, SQLITE_STORE_NAME))
+        atexit.register(store.close)
+        return store
+    raise Exception("No such cache backend: %s" % backend)
+
+
+def migrate_store(source, destination, compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+    """ Copies all the entries from one disk store to another, compressing
+        the big ones along the way. Entries that can't be read are skipped.
+        Returns the keys of the migrated entries.
+    """
+    logger = logging.getLogger(__name__)
+    migrated = []
+    for key in source.keys():
+        payload = source.load(key)
+        if payload is None:
+            continue
+        try:
+            data = decode_payload(payload)
+            end_time = _get_expiry_time(json.loads(data))
+        except (ValueError, KeyError, TypeError, zlib.error) as e:
+            logger.warning("Skipping unreadable cache entry %s: %s" % (key, e))
+            continue
+        destination.store(key, encode_payload(data, compress_threshold), end_time)
+        migrated.append(key)
+    destination.flush()
+    return migrated
 
 
 class Cache(object):
-    def __init__(self, cache_dir=None, default_lifetime=None):
+    def __init__(self, cache_dir=None, default_lifetime=None, memory_budget=DEFAULT_MEMORY_BUDGET,
+            backend=DEFAULT_BACKEND, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+            serve_stale=False):
         if not default_lifetime:
             default_lifetime = datetime.timedelta(days=1)
         if cache_dir and not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
         self.cache_dir = cache_dir
         self.default_lifetime = default_lifetime
-        self.items = {}
+        self.compress_threshold = compress_threshold
+        # Only worth it for long-running processes: a short one could exit
+        # before the background refresh is done, and keep old data around.
+        self.serve_stale = serve_stale
+        # Parsed objects are only kept as long as their raw data, so
+        # the memory budget bounds them too.
+        self.items = MemoryTier(memory_budget, on_remove=self._forget_parsed)
+        self.store = None
+        if cache_dir:
+            self.store = create_store(cache_dir, backend)
+        self.policies = []
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.flights = SingleFlight()
+        self.parsed = {}
+        self.parsed_hits = 0
+        self._parsed_lock = threading.Lock()
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+        self._sweeper = None
         self.logger = logging.getLogger(__name__)
 
+    def set_policy(self, prefix, lifetime, stale_lifetime=None):
+        """ Sets the lifetime of entries whose key starts with `prefix`.
+            If the cache serves stale entries, expired ones can still be
+            served by `get_or_fetch` during `stale_lifetime` while they're
+            refreshed in the background.
+        """
+        self.policies = [p for p in self.policies if p[0] != prefix]
+        self.policies.append((prefix, lifetime, stale_lifetime))
+        self.policies.sort(key=lambda p: len(p[0]), reverse=True)
+
+    def get_policy(self, key):
+        for prefix, lifetime, stale_lifetime in self.policies:
+            if key.startswith(prefix):
+                return (lifetime, stale_lifetime)
+        return (self.default_lifetime, None)
+
     def has(self, key):
         if key in self.items:
             return True
-        path = self._get_item_path(key)
-        if path and os.path.isfile(path):
+        if self.store is not None and self.store.has(key):
             return True
         return False
 
@@ -31,57 +537,247 @@ class Cache(object):
             if raise_on_miss:
                 raise Exception("Cache miss, key not found: %s" % key)
             self.logger.debug('Cache miss (reason: not found): %s' % key)
+            self.misses += 1
             return None
-        if item['end_time'] < time.time():
+        now = time.time()
+        if item['end_time'] < now:
             self.logger.debug('Cache miss (reason: outdated): %s' % key)
-            self.items.pop(key)
-            path = self._get_item_path(key)
-            if path and os.path.isfile(path):
-                os.remove(path)
+            self.misses += 1
+            if _get_expiry_time(item) < now:
+                self.items.pop(key)
+                if self.store is not None:
+                    self.store.delete(key)
             return None
         self.logger.debug('Cache hit: %s' % key)
+        self.hits += 1
         return item['data']
 
-    def set(self, key, data, lifetime=None):
+    def get_or_fetch(self, key, fetcher, lifetime=None, parser=None):
+        """ Gets the data for the given key, calling `fetcher` to get it
+            if needed. The fetcher receives the validators (ETag, etc.)
+            of the cached data and returns a `(data, validators)` tuple,
+            where `data` can be `NOT_MODIFIED`.
+            If a `parser` is given, `parser(data)` is returned instead,
+            and kept in memory until the cached data changes.
+        """
+        item = self._get_item(key)
+        now = time.time()
+        if item is not None and item['end_time'] >= now:
+            self.logger.debug('Cache hit: %s' % key)
+            self.hits += 1
+        elif self.serve_stale and item is not None and _get_expiry_time(item) >= now:
+            self.logger.debug('Cache hit (stale, refreshing): %s' % key)
+            self.stale_hits += 1
+            self._refresh_async(key, fetcher, item, lifetime)
+        else:
+            self.logger.debug('Cache miss (fetching): %s' % key)
+            self.misses += 1
+            item = self._fetch(key, fetcher, item, lifetime)
+        if parser is None:
+            return item['data']
+        return self._get_parsed(key, item, parser)
+
+    def set(self, key, data, lifetime=None, validators=None):
+        self._set_item(key, data, lifetime, validators)
+
+    def _set_item(self, key, data, lifetime=None, validators=None, stamp=None):
+        stale_lifetime = None
         if not lifetime:
-            lifetime = self.default_lifetime
+            lifetime, stale_lifetime = self.get_policy(key)
+        now = time.time()
         item = {
-                'end_time': time.time() + lifetime.total_seconds(),
+                'end_time': now + lifetime.total_seconds(),
+                'stamp': stamp or now,
                 'data': data
                 }
-        self.items[key] = item
-        path = self._get_item_path(key)
-        if path:
-            with open(path, 'w') as f:
-                json.dump(item, f)
+        if stale_lifetime:
+            item['stale_time'] = item['end_time'] + stale_lifetime.total_seconds()
+        if validators:
+            item['validators'] = validators
+        data = json.dumps(item)
+        self.items.put(key, item, len(data))
+        if self.store is not None:
+            payload = encode_payload(data, self.compress_threshold)
+            self.store.store(key, payload, _get_expiry_time(item))
         self.logger.debug('Cached: %s' % key)
+        return item
 
-    def _get_item_path(self, key):
-        if not self.cache_dir:
-            return None
-        return os.path.join(self.cache_dir, '%s.json' % key)
+    def _get_parsed(self, key, item, parser):
+        # Entries written before stamps existed are identified by their
+        # expiry time.
+        stamp = item.get('stamp', item['end_time'])
+        with self._parsed_lock:
+            entry = self.parsed.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.parsed_hits += 1
+            return entry[1]
+        result = parser(item['data'])
+        with self._parsed_lock:
+            # Checked under the lock, so that an eviction can't slip
+            # between the check and the write.
+            if key in self.items:
+                self.parsed[key] = (stamp, result)
+        return result
+
+    def _forget_parsed(self, key):
+        with self._parsed_lock:
+            self.parsed.pop(key, None)
+
+    def _fetch(self, key, fetcher, item, lifetime):
+        # Concurrent misses (and background refreshes) of the same key
+        # share a single call to the service.
+        def _do_fetch():
+            validators = {}
+            if item is not None:
+                validators = item.get('validators', {})
+            data, validators = fetcher(validators)
+            stamp = None
+            if data is NOT_MODIFIED:
+                # Keep the stamp so that parsed objects stay valid.
+                self.logger.debug('Not modified: %s' % key)
+                data = item['data']
+                stamp = item.get('stamp')
+            return self._set_item(key, data, lifetime, validators, stamp)
+
+        return self.flights.do(key, _do_fetch)
+
+    def _refresh_async(self, key, fetcher, item, lifetime):
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def _refresh():
+            try:
+                self._fetch(key, fetcher, item, lifetime)
+            except Exception as e:
+                self.logger.error('Error refreshing cache entry %s: %s' % (key, e))
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=_refresh, name=('cache-refresh-%s' % key))
+        thread.daemon = True
+        thread.start()
+
+    def flush(self):
+        if self.store is not None:
+            self.store.flush()
+
+    def sweep(self, quota=None):
+        """ Drops all expired entries from the disk cache, and then the
+            least recently used ones until it fits in `quota` bytes.
+        """
+        result = {'expired': 0, 'evicted': 0, 'reclaimed': 0}
+        if self.store is None:
+            return result
+        expired = self.store.delete_expired(time.time())
+        evicted = []
+        if quota is not None:
+            evicted = self.store.evict(quota)
+        for key, size in expired + evicted:
+            self.items.pop(key)
+            result['reclaimed'] += size
+        result['expired'] = len(expired)
+        result['evicted'] = len(evicted)
+        if expired or evicted:
+            self.logger.debug('Swept %d expired and %d evicted cache entries (%d bytes).' % (
+                    result['expired'], result['evicted'], result['reclaimed']))
+        return result
+
+    def start_sweeper(self, interval, quota=None):
+        """ Sweeps the cache every `interval` seconds on a background thread.
+        """
+        if self._sweeper is not None:
+            return
+        stop = threading.Event()
+
+        def _sweep_loop():
+            while not stop.wait(interval):
+                try:
+                    self.sweep(quota)
+                except Exception as e:
+                    self.logger.error('Error sweeping cache: %s' % e)
+
+        self._sweeper = (threading.Thread(target=_sweep_loop, name='cache-sweeper'), stop)
+        self._sweeper[0].daemon = True
+        self._sweeper[0].start()
+
+    def stop_sweeper(self):
+        if self._sweeper is None:
+            return
+        thread, stop = self._sweeper
+        stop.set()
+        thread.join()
+        self._sweeper = None
+
+    def get_disk_usage(self):
+        if self.store is None:
+            return {'entries': 0, 'size': 0, 'expired': 0}
+        return self.store.get_usage(time.time())
+
+    def get_stats(self):
+        stats = {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'fetches': self.flights.get_stats(),
+                'parsed_hits': self.parsed_hits,
+                'memory': self.items.get_stats()
+                }
+        return stats
 
     def _get_item(self, key):
-        if not key in self.items:
-            path = self._get_item_path(key)
-            if path and os.path.isfile(path):
-                self.logger.debug('Loading from disk cache: %s' % key)
-                with open(path, 'r') as f:
-                    item = json.load(f)
-                    self.items[key] = item
-                    return item
-        if key in self.items:
-            return self.items[key]
+        item = self.items.get(key)
+        if item is not None:
+            if self.store is not None:
+                self.store.touch(key)
+            return item
+        if self.store is None:
+            return None
+        payload = self.store.load(key)
+        if payload is not None:
+            self.logger.debug('Loading from disk cache: %s' % key)
+            data = decode_payload(payload)
+            item = json.loads(data)
+            # The JSON size is a good enough estimate of the memory
+            # used by the decoded item.
+            self.items.put(key, item, len(data))
+            return item
         return None
 
 
 class DummyCache:
+    def __init__(self):
+        self.flights = SingleFlight()
+
     def has(self, key):
         return False
 
     def get(self, key):
         return None
 
-    def set(self, key, data, lifetime=None):
+    def get_or_fetch(self, key, fetcher, lifetime=None, parser=None):
+        data = self.flights.do(key, lambda: fetcher({})[0])
+        if parser is None:
+            return data
+        return parser(data)
+
+    def set(self, key, data, lifetime=None, validators=None):
         pass
 
+    def set_policy(self, prefix, lifetime, stale_lifetime=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def sweep(self, quota=None):
+        return {'expired': 0, 'evicted': 0, 'reclaimed': 0}
+
+    def get_disk_usage(self):
+        return {'entries': 0, 'size': 0, 'expired': 0}
+
+    def get_stats(self):
+        return {'fetches': self.flights.get_stats()}
+
@@ -1,40 +1,408 @@
 import os
 import os.path
-import shutil
+import time
+import zlib
+import struct
+import tempfile
+import sqlite3
 import zipfile
+import threading
 import re
 import string
 import json
 import logging
+import urlparse
 import comicrack
 import comicbookinfo
+from multiprocessing.pool import ThreadPool
 from downloader import DownloadContext
 
 
 valid_path_chars = "-_.() /\\%s%s" % (string.ascii_letters, string.digits)
 
+PAGE_MANIFEST_NAME = 'ComicLiberationFront.json'
+LIBRARY_INDEX_NAME = '.clf_index.sqlite'
+ZIP_COMMENT_PROBE_SIZE = 4096
+# Temporary archives that haven't been written to for that long (in
+# seconds) were left behind by an interrupted sync.
+STALE_TEMP_OUTPUT_AGE = 60 * 60
+
+_umask = os.umask(0)
+os.umask(_umask)
+RAW_COPY_CHUNK_SIZE = 256 * 1024
+
+
+_invalid_path_chars = re.compile('[^\w\d &\-_\.\(\)\'/\\\\]')
+# Names given by `CbzBuilder._create_temp_output`.
+_temp_output_name = re.compile(r'^\..+\.cbz\..+\.tmp$', re.IGNORECASE)
+
 
 def _clean_path(path):
-    path = re.sub('[^\w\d &\-_\.\(\)\'/\\\\]', '-', path)
+    path = _invalid_path_chars.sub('-', path)
     path = string.strip(path, '-.')
     return path
 
 
+def _get_page_source(url):
+    # Page URLs are signed, so only their path identifies the image.
+    return urlparse.urlsplit(url).path
+
+
+def read_page_manifest(zf):
+    try:
+        data = zf.read(PAGE_MANIFEST_NAME)
+    except KeyError:
+        return None
+    return json.loads(data)
+
+
+def _copy_raw_entry(zfin, info, zfout, arcname=None):
+    """ Copies an entry from one archive to another without decompressing
+        and re-compressing it.
+    """
+    if arcname is None:
+        arcname = info.filename
+    if (info.file_size > zipfile.ZIP64_LIMIT or
+            info.compress_size > zipfile.ZIP64_LIMIT or
+            info.header_offset > zipfile.ZIP64_LIMIT):
+        # Let `zipfile` deal with the Zip64 extra fields.
+        zfout.writestr(arcname, zfin.read(info.filename), info.compress_type)
+        return
+
+    fp = zfin.fp
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header: %s" % info.filename)
+    header = struct.unpack(zipfile.structFileHeader, header)
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    zinfo = zipfile.ZipInfo(arcname, info.date_time)
+    zinfo.compress_type = info.compress_type
+    zinfo.comment = info.comment
+    zinfo.extra = info.extra
+    zinfo.create_system = info.create_system
+    zinfo.create_version = info.create_version
+    zinfo.extract_version = info.extract_version
+    zinfo.external_attr = info.external_attr
+    # The sizes and CRC go in the local header, not in a data descriptor.
+    zinfo.flag_bits = info.flag_bits & ~0x08
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+
+    def _read_chunks():
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fp.read(min(RAW_COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipfile("Truncated file data: %s" % info.filename)
+            remaining -= len(chunk)
+            yield chunk
+
+    _write_raw_entry(zfout, zinfo, _read_chunks())
+
+
+def _is_entry_intact(zf, entry):
+    """ Checks that an archive entry has the size and CRC recorded for
+        it in the page manifest, and that its data matches them.
+    """
+    try:
+        info = zf.getinfo(entry['name'])
+    except KeyError:
+        return False
+    if info.file_size != entry.get('size') or info.CRC != entry.get('crc'):
+        return False
+    try:
+        # `zipfile` checks the CRC of the data once it's all read.
+        with zf.open(info) as f:
+            while f.read(RAW_COPY_CHUNK_SIZE):
+                pass
+    except (zipfile.BadZipfile, zlib.error, IOError):
+        return False
+    return True
+
+
+def _write_raw_entry(zfout, zinfo, chunks):
+    """ Writes an entry whose data is already compressed, and whose
+        sizes and CRC are already set on `zinfo`.
+    """
+    zinfo.header_offset = zfout.fp.tell()
+    zfout._writecheck(zinfo)
+    zfout._didModify = True
+    zfout.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        zfout.fp.write(chunk)
+    zfout.filelist.append(zinfo)
+    zfout.NameToInfo[zinfo.filename] = zinfo
+
+
+def _write_entry(zf, name, data, policy):
+    compress_type = policy.get_compress_type(name)
+    zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    # Same permissions `ZipFile.writestr` gives entries it names itself.
+    zinfo.external_attr = 0600 << 16
+    if compress_type == zipfile.ZIP_STORED or policy.level is None:
+        zf.writestr(zinfo, data)
+        return
+    # `zipfile` doesn't let us choose the compression level.
+    compressor = zlib.compressobj(policy.level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    _write_raw_entry(zf, zinfo, [compressed])
+
+
+def _write_file(zf, path, arcname, policy):
+    compress_type = policy.get_compress_type(arcname)
+    if compress_type == zipfile.ZIP_STORED or policy.level is None:
+        zf.write(path, arcname, compress_type)
+        return
+    with open(path, 'rb') as f:
+        _write_entry(zf, arcname, f.read(), policy)
+
+
+class CompressionPolicy(object):
+    """ Decides how each entry of a CBZ file gets compressed. Images are
+        already compressed so they're stored as-is unless asked otherwise,
+        and everything else gets deflated.
+    """
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+    def __init__(self, compress_images=False, level=None):
+        self.compress_images = compress_images
+        self.level = level
+
+    def get_compress_type(self, name):
+        if (not self.compress_images and
+                os.path.splitext(name)[1].lower() in self.IMAGE_EXTENSIONS):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def get_json_data(self):
+        return {
+                'compress_images': self.compress_images,
+                'level': self.level
+                }
+
+    @staticmethod
+    def from_json_data(data):
+        if not data:
+            return CompressionPolicy()
+        return CompressionPolicy(
+                data.get('compress_images', False),
+                data.get('level'))
+
+
+def read_zip_comment(path):
+    """ Reads an archive's comment straight from its end of central
+        directory record. Returns `None` if the archive needs to be
+        opened with `zipfile` instead (Zip64 or unexpected layout).
+    """
+    with open(path, 'rb') as fp:
+        fp.seek(0, 2)
+        file_size = fp.tell()
+        # Most comments fit in the first read, otherwise go back as far
+        # as the largest possible comment.
+        for window in (ZIP_COMMENT_PROBE_SIZE, zipfile.sizeEndCentDir + 65535):
+            window = min(window, file_size)
+            fp.seek(file_size - window)
+            data = fp.read(window)
+            comment = _find_zip_comment(data)
+            if comment is not None or window == file_size:
+                return comment
+    return None
+
+
+def _find_zip_comment(data):
+    start = data.rfind(zipfile.stringEndArchive)
+    while start >= 0:
+        end = start + zipfile.sizeEndCentDir
+        if end <= len(data):
+            record = struct.unpack(zipfile.structEndArchive, data[start:end])
+            if end + record[zipfile._ECD_COMMENT_SIZE] == len(data):
+                if (record[zipfile._ECD_ENTRIES_TOTAL] == 0xFFFF or
+                        record[zipfile._ECD_OFFSET] == 0xFFFFFFFF):
+                    return None
+                locator = start - zipfile.sizeEndCentDir64Locator
+                if (locator >= 0 and
+                        data[locator:locator + 4] == zipfile.stringEndArchive64Locator):
+                    return None
+                return data[end:]
+        start = data.rfind(zipfile.stringEndArchive, 0, start)
+    return None
+
+
+def get_issue_info(path):
+    try:
+        comment = read_zip_comment(path)
+    except IOError:
+        comment = None
+    if comment is None:
+        with zipfile.ZipFile(path, 'r') as zf:
+            comment = zf.comment
+    if not comment:
+        return {}
+    cbi = json.loads(comment)
+    return cbi.get('x-ComicLiberationFront', {})
+
+
+def get_issue_infos(paths, workers=8):
+    """ Gets the ComicLiberationFront metadata of many issues at once.
+        Files that can't be read map to `None`.
+    """
+    def _read(path):
+        try:
+            return (path, get_issue_info(path))
+        except Exception:
+            return (path, None)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        return dict(pool.map(_read, paths))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_issue_version(path):
-    with zipfile.ZipFile(path, 'r') as zf:
-        if not zf.comment:
-            return -1
-        cbi = json.loads(zf.comment)
-    if not 'x-ComicLiberationFront' in cbi:
-        return -1
-    if not 'version' in cbi['x-ComicLiberationFront']:
+    info = get_issue_info(path)
+    if not 'version' in info:
         return -1
-    return cbi['x-ComicLiberationFront']['version']
+    return info['version']
+
+
+class CbzLibraryIndex(object):
+    """ A persistent index of the issues in a library, so that finding
+        out what's in there doesn't require opening every CBZ file.
+        Entries are validated against the file's size and mtime.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def get_info(self, path):
+        """ Gets the indexed info for the given issue file, refreshing it
+            if the file changed, or `None` if there's no such file.
+        """
+        with self._lock:
+            row = self._get_conn().execute(
+                    'SELECT comic_id, service, version, size, mtime FROM issues WHERE path=?',
+                    (path,)).fetchone()
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Most missing files were never indexed in the first place,
+            # only drop the ones that were.
+            if row is not None:
+                self.remove(path)
+            return None
+        if row is not None and row[3] == st.st_size and row[4] == st.st_mtime:
+            return {'comic_id': row[0], 'service': row[1], 'version': row[2]}
+        return self.refresh(path, st)
+
+    def get_version(self, path):
+        info = self.get_info(path)
+        if info is None:
+            return None
+        if info['version'] is None:
+            return -1
+        return info['version']
+
+    def find(self, service_name, comic_id):
+        with self._lock:
+            rows = self._get_conn().execute(
+                    'SELECT path FROM issues WHERE service=? AND comic_id=?',
+                    (service_name, comic_id)).fetchall()
+        for row in rows:
+            # The file may have been deleted or replaced since it was
+            # indexed, in which case `get_info` fixes the row.
+            info = self.get_info(row[0])
+            if (info is not None and info['service'] == service_name and
+                    unicode(info['comic_id']) == unicode(comic_id)):
+                return row[0]
+        return None
+
+    def refresh(self, path, st=None):
+        if st is None:
+            st = os.stat(path)
+        info = get_issue_info(path)
+        row = self._make_row(path, info, st)
+        with self._lock:
+            with self._get_conn() as conn:
+                conn.execute('INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?)', row)
+        return {'comic_id': row[1], 'service': row[2], 'version': row[3]}
+
+    def remove(self, path):
+        with self._lock:
+            with self._get_conn() as conn:
+                conn.execute('DELETE FROM issues WHERE path=?', (path,))
+
+    def rebuild(self, root_path, workers=8):
+        """ Re-creates the index by scanning every CBZ in the library.
+            Returns the number of indexed issues.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root_path):
+            dirnames[:] = [d for d in dirnames if d != 'dltmp']
+            for fn in filenames:
+                if fn.lower().endswith('.cbz'):
+                    paths.append(os.path.join(dirpath, fn))
+
+        rows = []
+        for path, info in get_issue_infos(paths, workers).iteritems():
+            try:
+                if info is None:
+                    raise Exception("can't read archive comment")
+                rows.append(self._make_row(path, info, os.stat(path)))
+            except Exception as e:
+                logging.getLogger(__name__).warning("Can't index '%s': %s" % (path, e))
+
+        with self._lock:
+            with self._get_conn() as conn:
+                conn.execute('DELETE FROM issues')
+                conn.executemany('INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _make_row(self, path, info, st):
+        return (path,
+                info.get('comic_id'),
+                info.get('service'),
+                info.get('version'),
+                st.st_size,
+                st.st_mtime)
+
+    def _get_conn(self):
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                        'CREATE TABLE IF NOT EXISTS issues ('
+                        'path TEXT PRIMARY KEY, comic_id TEXT, service TEXT, '
+                        'version, size INTEGER, mtime REAL)')
+                self._conn.execute(
+                        'CREATE INDEX IF NOT EXISTS issues_comic_id ON issues (service, comic_id)')
+        return self._conn
 
 
 class CbzLibrary(object):
-    def __init__(self, root_path):
+    def __init__(self, root_path, index=None):
         self.root_path = root_path
+        if index is None:
+            index = CbzLibraryIndex(os.path.join(root_path, LIBRARY_INDEX_NAME))
+        self.index = index
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Initializing CBZ library at '%s'." % root_path)
 
@@ -50,6 +418,10 @@ class CbzLibrary(object):
         return files
 
     def get_issue_path(self, issue):
+        path = issue.memoize('library_path', lambda: self._get_relative_issue_path(issue))
+        return os.path.join(self.root_path, path)
+
+    def _get_relative_issue_path(self, issue):
         volume = issue.parent
         series = volume.parent
         path = _clean_path(series.title)
@@ -62,7 +434,60 @@ class CbzLibrary(object):
             issue_dt = issue.get_display_title(False, ' - ', ' Vol.', ' ', ' ')
             path += os.sep + _clean_path(issue_dt)
             path += '.cbz'
-        return os.path.join(self.root_path, path)
+        return path
+
+    def remove_stale_temp_files(self, max_age=STALE_TEMP_OUTPUT_AGE):
+        """ Deletes the temporary archives left behind by interrupted
+            syncs. Returns the number of deleted files.
+        """
+        count = 0
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.root_path):
+            dirnames[:] = [d for d in dirnames if d != 'dltmp']
+            for fn in filenames:
+                if not _temp_output_name.match(fn):
+                    continue
+                path = os.path.join(dirpath, fn)
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                        count += 1
+                except OSError as e:
+                    self.logger.warning("Can't remove '%s': %s" % (path, e))
+        return count
+
+    def has_issue(self, issue, service_name):
+        if self.index.find(service_name, issue.comic_id) is not None:
+            return True
+        # Issues downloaded by older versions don't record their ID.
+        return self.index.get_info(self.get_issue_path(issue)) is not None
+
+    def get_sync_action(self, issue, metadata_only=False, new_only=False, force=False):
+        """ Figures out what syncing an issue takes, and why. The action
+            is `'new'` for an issue that's not in the library yet, `'save'`
+            for one that needs downloading again, `'update'` for one that
+            only needs its metadata re-written, and `None` for one that's
+            left alone. The reason is `None` when that's not worth telling.
+        """
+        local_version = self.index.get_version(self.get_issue_path(issue))
+        if local_version is None:
+            if metadata_only:
+                return (None, None)
+            return ('new', 'new')
+        if new_only:
+            return (None, None)
+
+        if force:
+            reason = 'forced'
+        else:
+            local_version = int(local_version)
+            remote_version = int(issue.metadata.version)
+            if remote_version <= local_version:
+                return (None, '%d[remote] <= %d[local]' % (remote_version, local_version))
+            reason = '%d[remote] > %d[local]' % (remote_version, local_version)
+        if metadata_only:
+            return ('update', reason)
+        return ('save', reason)
 
     def sync_issues(self, builder, issues, 
             metadata_only=False, 
@@ -71,130 +496,321 @@ class CbzLibrary(object):
         for i, issue in enumerate(issues):
             prefix = "[%s] %s" % (issue.comic_id, issue.get_display_title())
             path = self.get_issue_path(issue)
-            if os.path.isfile(path):
-                if new_only:
-                    continue
-                do_sync = False
-                do_sync_reason = None
-                if force:
-                    do_sync = True
-                    do_sync_reason = 'forced'
-                else:
-                    local_version = int(get_issue_version(path))
-                    remote_version = int(issue.metadata.version)
-                    if remote_version > local_version:
-                        do_sync = True
-                        do_sync_reason = '%d[remote] > %d[local]' % (remote_version, local_version)
-                    else:
-                        do_sync_reason = '%d[remote] <= %d[local]' % (remote_version, local_version)
-
-                if do_sync:
-                    self.logger.info("%s: syncing issue (reason: %s)" % (prefix, do_sync_reason))
-                    if metadata_only:
-                        builder.update(issue, in_library=self)
-                    else:
-                        os.rename(path, path + '.old')
-                        builder.save(issue, in_library=self)
-                        os.remove(path + '.old')
-                else:
-                    self.logger.info("%s: up-to-date (%s)" % (prefix, do_sync_reason))
-            elif not metadata_only:
+            action, reason = self.get_sync_action(issue, metadata_only, new_only, force)
+            if action is None:
+                if reason is not None:
+                    self.logger.info("%s: up-to-date (%s)" % (prefix, reason))
+                continue
+
+            if action == 'new':
                 self.logger.info("%s: downloading (new)" % prefix)
                 builder.save(issue, in_library=self)
+            else:
+                self.logger.info("%s: syncing issue (reason: %s)" % (prefix, reason))
+                if action == 'update':
+                    builder.update(issue, in_library=self)
+                else:
+                    builder.save(issue, in_library=self, previous=path)
+            if os.path.isfile(path):
+                self.index.refresh(path)
+        self.logger.info("Sync summary: %s" % builder.get_stats_summary())
+
+
+class _BuildJob(object):
+    # An issue between its download and its packaging.
+    def __init__(self, issue, out_path, subscriber):
+        self.issue = issue
+        self.out_path = out_path
+        self.subscriber = subscriber
+        self.temp_folder = None
+        self.ci = None
+        self.cbi = None
+        self.prev_zf = None
+        self.reused = {}
+        self.out_fp = None
+        self.temp_out_path = None
+        self.ctx = None
+        self.downloader = None
+        self.packaged = False
 
 
 class CbzBuilder(object):
-    def __init__(self, service, username=None, subscriber=None, temp_folder=None):
+    def __init__(self, service, username=None, subscriber=None, temp_folder=None, jobs=None,
+            compression=None, fsync=True):
+        if compression is None:
+            compression = CompressionPolicy()
         self.service = service
         self.username = username
         self.subscriber = subscriber
         self.temp_folder = temp_folder
-
-    def update(self, issue, out_path=None, in_library=None):
+        self.jobs = jobs
+        self.compression = compression
+        self.fsync = fsync
+        self.stats = {'issues': 0, 'package_time': 0.0, 'bytes_written': 0}
+        self._stats_lock = threading.Lock()
+
+    def get_stats_summary(self):
+        return "%d issues packaged, %.2fs packaging, %.1f MB written" % (
+                self.stats['issues'],
+                self.stats['package_time'],
+                self.stats['bytes_written'] / (1024.0 * 1024.0))
+
+    def update(self, issue, out_path=None, in_library=None, subscriber=None):
         if out_path is None:
             if in_library is not None:
                 out_path = in_library.get_issue_path(issue)
             else:
                 raise Exception("You must specify either an output path or a library.")
+        if subscriber is None:
+            subscriber = self.subscriber
 
-        self.subscriber.progress(value=0, message="Re-creating metadata...")
-        ci, cbi = self._get_metadata(issue)
-
-        self.subscriber.progress(value=30, message=("Updating CBZ: %s..." % out_path))
-        os.rename(out_path, out_path + '.old')
-        with zipfile.ZipFile(out_path + '.old', 'a') as zfin:
-            with zipfile.ZipFile(out_path, 'w') as zfout:
-                for info in zfin.infolist():
-                    if info.filename == 'ComicInfo.xml':
-                        zfout.writestr('ComicInfo.xml', unicode(str(ci), 'utf-8'))
-                    else:
-                        zfout.writestr(info, zfin.read(info.filename))
-                zfout.comment = cbi.get_json_str()
-
-        self.subscriber.progress(value=60, message="Cleaning up...")
-        os.remove(out_path + '.old')
-        self.subscriber.progress(value=100)
-
-    def save(self, issue, out_path=None, in_library=None):
+        # Keep compressing the way the archive was first created.
+        compression = CompressionPolicy.from_json_data(
+                get_issue_info(out_path).get('compression'))
+
+        subscriber.progress(value=0, message="Re-creating metadata...")
+        ci, cbi = self._get_metadata(issue, compression)
+
+        subscriber.progress(value=30, message=("Updating CBZ: %s..." % out_path))
+        out_fp, temp_out_path = self._create_temp_output(out_path)
+        try:
+            start_time = time.time()
+            with zipfile.ZipFile(out_path, 'r') as zfin:
+                with zipfile.ZipFile(out_fp, 'w') as zfout:
+                    # Only the metadata changes, the pages are copied as-is.
+                    for info in zfin.infolist():
+                        if info.filename == 'ComicInfo.xml':
+                            _write_entry(zfout, 'ComicInfo.xml', str(ci), compression)
+                        else:
+                            _copy_raw_entry(zfin, info, zfout)
+                    zfout.comment = cbi.get_json_str()
+            self._add_package_stats(time.time() - start_time, out_fp.tell())
+            self._publish(out_fp, temp_out_path, out_path)
+        finally:
+            self._discard_temp_output(out_fp, temp_out_path)
+        subscriber.progress(value=100)
+
+    def save(self, issue, out_path=None, in_library=None, previous=None):
+        job = self.download(issue, out_path, in_library, previous)
+        self.package(job)
+
+    def download(self, issue, out_path=None, in_library=None, previous=None, subscriber=None):
+        """ Downloads the pages of an issue, and returns the job to give
+            to `package` to create the CBZ file.
+            Downloaders that can stream pages write the archive right
+            away, so `package` only has to publish it.
+        """
         if out_path is None:
             if in_library is not None:
                 out_path = in_library.get_issue_path(issue)
             else:
                 raise Exception("You must specify either an output path or a library.")
+        if subscriber is None:
+            subscriber = self.subscriber
+        job = _BuildJob(issue, out_path, subscriber)
 
         temp_folder = self.temp_folder
         if temp_folder is None:
             temp_folder = os.path.dirname(out_path)
-        temp_folder = os.path.join(temp_folder, 'dltmp', self.service.service_name, issue.comic_id)
-        if not os.path.exists(temp_folder):
-            os.makedirs(temp_folder)
+        job.temp_folder = os.path.join(temp_folder, 'dltmp', self.service.service_name, issue.comic_id)
+        if not os.path.exists(job.temp_folder):
+            os.makedirs(job.temp_folder)
 
         out_dir = os.path.dirname(out_path)
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-        self.subscriber.progress(value=0, message="Creating metadata...")
-        ci, cbi = self._get_metadata(issue)
+        subscriber.progress(value=0, message="Creating metadata...")
+        job.ci, job.cbi = self._get_metadata(issue, self.compression)
 
-        self.subscriber.progress(value=5, message="Downloading pages...")
-        self.subscriber.set_progress_limits(5, 85)
-        ctx = DownloadContext(temp_folder, self.subscriber)
-        downloader = self.service.get_issue_downloader(issue, ctx)
-        downloader.download()
-        self.subscriber.set_progress_limits(0, 100)
+        # When re-syncing, pages that didn't change are taken from the
+        # previous version of the archive instead of being downloaded.
+        if previous is not None and hasattr(issue.metadata, 'pages'):
+            job.prev_zf = zipfile.ZipFile(previous, 'r')
+            job.reused = self._get_reusable_pages(issue, job.prev_zf)
+            subscriber.info("Re-using %d of %d pages from the previous version." % (
+                    len(job.reused), len(issue.metadata.pages)))
 
-        self.subscriber.progress(90, "Creating CBZ: %s" % out_path)
         try:
-            temp_out_path = os.path.join(temp_folder, 'comic.cbz')
-            with zipfile.ZipFile(temp_out_path, 'w') as zf:
-                zf.writestr('ComicInfo.xml', unicode(str(ci), 'utf-8'))
-                for name in ctx.pages:
-                    zf.write(name, os.path.basename(name))
-                zf.comment = cbi.get_json_str()
-            shutil.copyfile(temp_out_path, out_path)
-        except Exception as e:
-            message = ("Couldn't create CBZ file: %s" % e)
-            self.subscriber.error(message)
-            return
-
-        self.subscriber.progress(95, "Cleaning up...")
+            subscriber.progress(value=5, message="Downloading pages...")
+            job.ctx = DownloadContext(job.temp_folder, subscriber, jobs=self.jobs)
+            job.ctx.skip_pages = set(job.reused)
+            job.downloader = self.service.get_issue_downloader(issue, job.ctx)
+            subscriber.set_progress_limits(5, 85)
+            if job.downloader.can_stream():
+                # The downloader writes the pages straight into the archive
+                # as they come in.
+                job.out_fp, job.temp_out_path = self._create_temp_output(out_path)
+                package_time = [0.0]
+                with zipfile.ZipFile(job.out_fp, 'w') as zf:
+                    def _write_page(name, data):
+                        start_time = time.time()
+                        _write_entry(zf, name, data, self.compression)
+                        package_time[0] += time.time() - start_time
+
+                    _write_page('ComicInfo.xml', str(job.ci))
+                    job.ctx.page_writer = _write_page
+                    job.downloader.download()
+                    self._write_page_manifest(zf, issue)
+                    zf.comment = job.cbi.get_json_str()
+                self._add_package_stats(package_time[0], job.out_fp.tell())
+                job.packaged = True
+            else:
+                job.downloader.download()
+            subscriber.set_progress_limits(0, 100)
+        except:
+            self._discard_job(job)
+            raise
+        return job
+
+    def package(self, job):
+        """ Creates the CBZ file of an issue downloaded with `download`.
+            Returns whether it was created.
+        """
+        subscriber = job.subscriber
+        out_path = job.out_path
         try:
-            for name in ctx.pages:
-                os.remove(name)
-            downloader.cleanup()
-            os.remove(temp_out_path)
-            os.rmdir(temp_folder)
+            subscriber.progress(90, "Creating CBZ: %s" % out_path)
+            try:
+                if not job.packaged:
+                    # Only now, so that nothing sits in the library while
+                    # the pages are downloading or waiting to be packaged.
+                    job.out_fp, job.temp_out_path = self._create_temp_output(out_path)
+                    prev_zf = job.prev_zf
+                    start_time = time.time()
+                    with zipfile.ZipFile(job.out_fp, 'w') as zf:
+                        _write_entry(zf, 'ComicInfo.xml', str(job.ci), self.compression)
+                        for idx, name in enumerate(job.ctx.pages):
+                            if idx in job.reused:
+                                # Same naming as `PagesIssueDownloader`.
+                                _copy_raw_entry(prev_zf, prev_zf.getinfo(job.reused[idx]), zf,
+                                        '%04d.jpg' % (idx + 1))
+                            else:
+                                _write_file(zf, name, os.path.basename(name), self.compression)
+                        self._write_page_manifest(zf, job.issue)
+                        zf.comment = job.cbi.get_json_str()
+                    self._add_package_stats(time.time() - start_time, job.out_fp.tell())
+                if job.prev_zf is not None:
+                    job.prev_zf.close()
+                    job.prev_zf = None
+                self._publish(job.out_fp, job.temp_out_path, out_path)
+            except Exception as e:
+                message = ("Couldn't create CBZ file: %s" % e)
+                subscriber.error(message)
+                return False
+        finally:
+            self._discard_job(job)
+
+        subscriber.progress(95, "Cleaning up...")
+        try:
+            for name in job.ctx.pages:
+                if name is not None:
+                    os.remove(name)
+            job.downloader.cleanup()
+            os.rmdir(job.temp_folder)
         except Exception as e:
             message = ("Error while cleaning up: %s\nThe comic has however been successfully downloaded." % e)
-            self.subscriber.error(message)
-
-        self.subscriber.progress(value=100, message=("Issue downloaded to: %s" % out_path))
-
-
-    def _get_metadata(self, issue):
+            subscriber.error(message)
+
+        subscriber.progress(value=100, message=("Issue downloaded to: %s" % out_path))
+        return True
+
+    def _discard_job(self, job):
+        if job.prev_zf is not None:
+            job.prev_zf.close()
+            job.prev_zf = None
+        if job.out_fp is not None:
+            self._discard_temp_output(job.out_fp, job.temp_out_path)
+
+    def _create_temp_output(self, out_path):
+        # The archive is written next to its destination and renamed
+        # into place once complete, so nobody sees a half-written file.
+        fd, temp_path = tempfile.mkstemp(
+                prefix=('.%s.' % os.path.basename(out_path)),
+                suffix='.tmp',
+                dir=os.path.dirname(out_path))
+        return (os.fdopen(fd, 'w+b'), temp_path)
+
+    def _publish(self, out_fp, temp_path, out_path):
+        out_fp.flush()
+        if self.fsync:
+            os.fsync(out_fp.fileno())
+        out_fp.close()
+
+        # `mkstemp` creates private files, give it the permissions a
+        # regular file would get.
+        if os.path.exists(out_path):
+            os.chmod(temp_path, os.stat(out_path).st_mode & 0777)
+        else:
+            os.chmod(temp_path, 0666 & ~_umask)
+        if os.name == 'nt' and os.path.exists(out_path):
+            # No atomic replace on Windows.
+            os.remove(out_path)
+        os.rename(temp_path, out_path)
+
+        if self.fsync and hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(out_path), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def _discard_temp_output(self, out_fp, temp_path):
+        if not out_fp.closed:
+            out_fp.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def _get_reusable_pages(self, issue, prev_zf):
+        # Pages are matched on their URL path and size: the service
+        # doesn't give us anything like a checksum of its images. The
+        # CRC recorded in the manifest makes sure the copy we have is
+        # intact, otherwise the page is downloaded again.
+        manifest = read_page_manifest(prev_zf)
+        if not manifest:
+            return {}
+        previous_pages = {}
+        for entry in manifest['pages']:
+            if 'source' in entry:
+                previous_pages[(entry['source'], entry['size'])] = entry
+        reused = {}
+        for idx, page in enumerate(issue.metadata.pages):
+            key = (_get_page_source(page.url), page.size)
+            entry = previous_pages.get(key)
+            if entry is not None and _is_entry_intact(prev_zf, entry):
+                reused[idx] = entry['name']
+        return reused
+
+    def _write_page_manifest(self, zf, issue):
+        sources = []
+        if hasattr(issue.metadata, 'pages'):
+            sources = [_get_page_source(p.url) for p in issue.metadata.pages]
+        entries = []
+        for info in zf.infolist():
+            if info.filename in ('ComicInfo.xml', PAGE_MANIFEST_NAME):
+                continue
+            entry = {
+                    'name': info.filename,
+                    'size': info.file_size,
+                    'crc': info.CRC
+                    }
+            if len(entries) < len(sources):
+                entry['source'] = sources[len(entries)]
+            entries.append(entry)
+        _write_entry(zf, PAGE_MANIFEST_NAME, json.dumps({'pages': entries}), self.compression)
+
+    def _add_package_stats(self, package_time, size):
+        with self._stats_lock:
+            self.stats['issues'] += 1
+            self.stats['package_time'] += package_time
+            self.stats['bytes_written'] += size
+
+    def _get_metadata(self, issue, compression):
         ci_notes = "Tool: ComicLiberationFront/0.1.0\n"
         cbi_extra = {
-                'version': issue.metadata.version
+                'version': issue.metadata.version,
+                'comic_id': issue.comic_id,
+                'compression': compression.get_json_data()
                 }
         if self.service:
             ci_notes += "Service: %s\n" % self.service.service_name
@@ -1,6 +1,14 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_LOAD_WORKERS = 8
 
 
 class _ParentChildList(list):
+    __slots__ = ('_parent',)
+
     def __init__(self, parent):
         list.__init__(self)
         self._parent = parent
@@ -10,22 +18,155 @@ class _ParentChildList(list):
         # reference as a different attribute.
         item.parent = value
 
+    def _attach(self, item):
+        self._parent_setter(item, self._parent)
+        collection = _find_collection(self._parent)
+        if collection is not None:
+            collection._add_to_index(item)
+
+    def _detach(self, item):
+        collection = _find_collection(self._parent)
+        if collection is not None:
+            collection._remove_from_index(item)
+        self._parent_setter(item, None)
+
     def append(self, item):
         list.append(self, item)
-        self._parent_setter(item, self._parent)
+        self._attach(item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._attach(item)
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._detach(item)
+
+    def pop(self, index=-1):
+        item = list.pop(self, index)
+        self._detach(item)
+        return item
 
     def __setitem__(self, key, value):
-        self._parent_setter(self[key], None)
+        self._detach(self[key])
         list.__setitem__(self, key, value)
-        self._parent_setter(value, self._parent)
+        self._attach(value)
 
     def __delitem__(self, key):
-        self._parent_setter(self[key], None)
+        self._detach(self[key])
         list.__delitem__(self, key)
 
 
+def get_fields(obj):
+    """ Gets the attributes of a model object as a dictionary.
+    """
+    fields = {}
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name == '_memo' or not hasattr(obj, name):
+                continue
+            # Memoized attributes are stored in an underscored slot.
+            if isinstance(getattr(type(obj), name[1:], None), _MemoizedAttribute):
+                name = name[1:]
+            fields[name] = getattr(obj, name)
+    return fields
+
+
+class _MemoizedAttribute(property):
+    pass
+
+
+def _memoized_attribute(name):
+    # An attribute whose changes invalidate the memoized values (display
+    # titles, paths...) that depend on it.
+    slot = '_' + name
+
+    def _get(self):
+        return getattr(self, slot)
+
+    def _set(self, value):
+        setattr(self, slot, value)
+        self._invalidate()
+
+    return _MemoizedAttribute(_get, _set)
+
+
+class _ModelNode(object):
+    __slots__ = ('_memo',)
+
+    def memoize(self, key, func):
+        """ Gets the value for `key` memoized on this node, calling
+            `func` to compute it the first time. Memoized values are
+            dropped when the title, number or parent of this node or
+            of one of its ancestors changes.
+        """
+        memo = self._memo
+        if memo is None:
+            memo = self._memo = {}
+        try:
+            return memo[key]
+        except KeyError:
+            value = memo[key] = func()
+            return value
+
+    def _invalidate(self):
+        self._memo = None
+
+
+def _find_collection(obj):
+    while obj is not None and not isinstance(obj, Collection):
+        obj = obj.parent
+    return obj
+
+
+def iter_loaded_volumes(volumes, workers=DEFAULT_LOAD_WORKERS):
+    """ Yields the given volumes as their issues get loaded, loading
+        several of them concurrently. Volumes that fail to load are
+        logged and skipped.
+    """
+    pending = []
+    for vol in volumes:
+        if vol.is_loaded:
+            yield vol
+        else:
+            pending.append(vol)
+    if not pending:
+        return
+
+    pool = ThreadPool(min(workers, len(pending)))
+    try:
+        for vol, error in pool.imap_unordered(_load_volume, pending):
+            if error is not None:
+                logging.getLogger(__name__).error("Can't load volume [%s] %s: %s" % (
+                        vol.volume_id, vol.title, error))
+                continue
+            yield vol
+    finally:
+        # Stops the remaining loads if the caller didn't go through
+        # all the volumes.
+        pool.terminate()
+        pool.join()
+
+
+def _load_volume(volume):
+    try:
+        volume.issues
+    except Exception as e:
+        return (volume, e)
+    return (volume, None)
+
+
 class Collection(object):
+    __slots__ = ('series', '_series_index', '_volume_index', '_issue_index')
+
     def __init__(self):
+        self._series_index = {}
+        self._volume_index = {}
+        self._issue_index = {}
         self.series = _ParentChildList(self)
 
     def __iter__(self):
@@ -33,23 +174,96 @@ class Collection(object):
             yield s
 
     def get_series(self, series_id):
-        for s in self.series:
-            if s.series_id == series_id:
-                return s
-        return None
+        return self._series_index.get(series_id)
+
+    def get_volume(self, volume_id):
+        return self._volume_index.get(volume_id)
+
+    def get_issue(self, comic_id):
+        """ Gets an issue by ID, if its volume has been loaded.
+        """
+        return self._issue_index.get(comic_id)
+
+    def get_issue_locations(self):
+        """ Gets the series and volume IDs of all the loaded issues,
+            keyed by comic ID.
+        """
+        locations = {}
+        for comic_id, issue in self._issue_index.items():
+            vol = issue.parent
+            if vol is not None and vol.parent is not None:
+                locations[comic_id] = (vol.parent.series_id, vol.volume_id)
+        return locations
 
     def get_issues(self):
         for s in self.series:
             for i in s.get_issues():
                 yield i
 
+    def get_volumes(self):
+        for s in self.series:
+            for v in s.volumes:
+                yield v
+
+    def load_all(self, workers=DEFAULT_LOAD_WORKERS):
+        """ Loads the issues of all the volumes, using several threads.
+        """
+        for vol in iter_loaded_volumes(self.get_volumes(), workers):
+            pass
+
+    def iter_issues(self, workers=DEFAULT_LOAD_WORKERS):
+        """ Like `get_issues`, but loads volumes concurrently, and yields
+            their issues as soon as they're loaded.
+        """
+        for vol in iter_loaded_volumes(self.get_volumes(), workers):
+            for i in vol.issues:
+                yield i
+
+    def _add_to_index(self, item):
+        if isinstance(item, Series):
+            self._series_index[item.series_id] = item
+            for v in item.volumes:
+                self._add_to_index(v)
+        elif isinstance(item, Volume):
+            self._volume_index[item.volume_id] = item
+            if item.is_loaded:
+                for i in item.issues:
+                    self._add_to_index(i)
+        elif isinstance(item, Issue):
+            self._issue_index[item.comic_id] = item
+
+    def _remove_from_index(self, item):
+        if isinstance(item, Series):
+            self._remove_indexed(self._series_index, item.series_id, item)
+            for v in item.volumes:
+                self._remove_from_index(v)
+        elif isinstance(item, Volume):
+            self._remove_indexed(self._volume_index, item.volume_id, item)
+            if item.is_loaded:
+                for i in item.issues:
+                    self._remove_from_index(i)
+        elif isinstance(item, Issue):
+            self._remove_indexed(self._issue_index, item.comic_id, item)
+
+    def _remove_indexed(self, index, key, item):
+        if index.get(key) is item:
+            del index[key]
+
+
+class Series(_ModelNode):
+    __slots__ = ('_title', 'series_id', 'logo_url', '_parent', 'volumes',
+            # Set by the web views.
+            'small_logo_url')
+
+    title = _memoized_attribute('title')
+    parent = _memoized_attribute('parent')
 
-class Series(object):
     def __init__(self, title=None):
-        self.title = title
+        self._memo = None
+        self._title = title
         self.series_id = None
         self.logo_url = None
-        self.parent = None
+        self._parent = None
         self.volumes = _ParentChildList(self)
 
     def __iter__(self):
@@ -71,7 +285,16 @@ class Series(object):
     def has_unique_volume(self):
         return len(self.volumes) == 1 and self.volumes[0].is_transparent
 
+    @property
+    def display_title(self):
+        return self.get_display_title()
+
     def get_display_title(self, volume_title_sep=None, volume_num_sep=None):
+        return self.memoize(
+                ('display_title', volume_title_sep, volume_num_sep),
+                lambda: self._build_display_title(volume_title_sep, volume_num_sep))
+
+    def _build_display_title(self, volume_title_sep, volume_num_sep):
         if self.has_unique_volume:
             return self.volumes[0].get_display_title(True, volume_title_sep, volume_num_sep)
         return self.title
@@ -81,18 +304,44 @@ class Series(object):
             for issue in vol.get_issues():
                 yield issue
 
+    def _invalidate(self):
+        self._memo = None
+        for v in self.volumes:
+            v._invalidate()
+
+
+class Volume(_ModelNode):
+    __slots__ = ('_title', 'volume_id', '_volume_num', 'logo_url', '_is_transparent', '_parent',
+            '_issues', '_issues_loader', '_issues_lock', '_preview_issue_count')
+
+    title = _memoized_attribute('title')
+    volume_num = _memoized_attribute('volume_num')
+    is_transparent = _memoized_attribute('is_transparent')
 
-class Volume(object):
     def __init__(self, title=None):
-        self.title = title
+        self._memo = None
+        self._title = title
         self.volume_id = None
-        self.volume_num = None
+        self._volume_num = None
         self.logo_url = None
-        self.is_transparent = False
+        self._is_transparent = False
         self._issues = None
         self._issues_loader = None
+        self._issues_lock = threading.Lock()
         self._preview_issue_count = None
-        self.parent = None
+        self._parent = None
+
+    def _get_parent(self):
+        return self._parent
+
+    def _set_parent(self, value):
+        # The display title of a series depends on its volumes.
+        if self._parent is not None:
+            self._parent._memo = None
+        self._parent = value
+        self._invalidate()
+
+    parent = _MemoizedAttribute(_get_parent, _set_parent)
 
     def __iter__(self):
         for i in self.issues:
@@ -104,18 +353,36 @@ class Volume(object):
             return self._preview_issue_count
         return len(self.issues)
 
+    @property
+    def is_loaded(self):
+        return self._issues is not None
+
     @property
     def issues(self):
         if self._issues is not None:
             return self._issues
-        self._issues = _ParentChildList(self)
-        if self._issues_loader is not None:
-            loaded = self._issues_loader(self.volume_id)
-            for l in loaded:
-                self._issues.append(l)
+        with self._issues_lock:
+            if self._issues is None:
+                # Only publish the list once it's complete, so other
+                # threads never see a partially loaded volume.
+                issues = _ParentChildList(self)
+                if self._issues_loader is not None:
+                    loaded = self._issues_loader(self.volume_id)
+                    for l in loaded:
+                        issues.append(l)
+                self._issues = issues
         return self._issues
 
+    @property
+    def display_title(self):
+        return self.get_display_title()
+
     def get_display_title(self, with_series_title=True, title_sep=None, num_sep=None):
+        return self.memoize(
+                ('display_title', with_series_title, title_sep, num_sep),
+                lambda: self._build_display_title(with_series_title, title_sep, num_sep))
+
+    def _build_display_title(self, with_series_title, title_sep, num_sep):
         if title_sep is None:
             title_sep = ': '
         if num_sep is None:
@@ -153,20 +420,50 @@ class Volume(object):
     def get_issues(self):
         return self.issues
 
+    def _invalidate(self):
+        self._memo = None
+        if self._parent is not None:
+            self._parent._memo = None
+        if self._issues is not None:
+            for i in self._issues:
+                i._invalidate()
+
+
+class Issue(_ModelNode):
+    __slots__ = ('_title', 'comic_id', '_num', 'cover_url', 'url', 'price', '_parent',
+            '_metadata', '_metadata_loader',
+            # Set by some services.
+            'series_id', 'volume_id',
+            # Set by the web views.
+            'series_title', 'path', 'downloaded', 'small_cover_url')
+
+    title = _memoized_attribute('title')
+    num = _memoized_attribute('num')
+    parent = _memoized_attribute('parent')
 
-class Issue(object):
     def __init__(self, title=None):
-        self.title = title
+        self._memo = None
+        self._title = title
         self.comic_id = None
-        self.num = None
+        self._num = None
         self.cover_url = None
         self.url = None
         self.price = 0
-        self.parent = None
+        self._parent = None
         self._metadata = None
         self._metadata_loader = None
 
+    @property
+    def display_title(self):
+        return self.get_display_title()
+
     def get_display_title(self, with_volume_title=True, volume_title_sep=None, volume_num_sep=None, title_sep=None, num_sep=None):
+        return self.memoize(
+                ('display_title', with_volume_title, volume_title_sep, volume_num_sep, title_sep, num_sep),
+                lambda: self._build_display_title(
+                    with_volume_title, volume_title_sep, volume_num_sep, title_sep, num_sep))
+
+    def _build_display_title(self, with_volume_title, volume_title_sep, volume_num_sep, title_sep, num_sep):
         if title_sep is None:
             title_sep = ' - '
         if num_sep is None:
@@ -192,6 +489,10 @@ class Issue(object):
 
         return dt
 
+    @property
+    def is_metadata_loaded(self):
+        return self._metadata is not None
+
     @property
     def metadata(self):
         if self._metadata is None:
@@ -204,6 +505,8 @@ class Issue(object):
         self._metadata = metadata
         if self._metadata is not None:
             self._metadata.parent = self
+        # Library paths depend on the metadata.
+        self._invalidate()
 
     def set_metadata_loader(self, metadata_loader):
         self._metadata_loader = metadata_loader
@@ -213,7 +516,11 @@ class Issue(object):
 
 
 class IssueMetadata(object):
+    __slots__ = ('is_volume_tpb', 'version', 'publisher', 'imprint', 'synopsis',
+            'print_publish_date', 'creators', 'parent')
+
     def __init__(self):
+        self.parent = None
         self.is_volume_tpb = False
         self.version = None
         self.publisher = None
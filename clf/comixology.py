@@ -1,7 +1,6 @@
+import array
 import datetime
-import json
 import urllib
-import urllib2
 import urlparse
 import logging
 from service import ServiceAccount
@@ -16,9 +15,31 @@ COMIXOLOGY_API_NAMES = {
         'windows8': 'com.iconology.windows.comics'
         }
 COMIXOLOGY_API_VERSION = '3.0'
+COMIXOLOGY_PAGE_JOBS = 4
+
+
+def _split_url(url):
+    # Page URLs of an issue share long prefixes, so only one copy of each
+    # prefix is kept. Interned strings go away with their last reference,
+    # unlike the entries of a global table. URLs are stored as UTF-8, which
+    # for these ASCII URLs takes a fraction of the memory of unicode strings.
+    if url is None:
+        return (None, None)
+    if isinstance(url, unicode):
+        url = url.encode('utf8')
+    idx = url.rfind('/') + 1
+    return (intern(url[:idx]), url[idx:])
+
+
+def _join_url(prefix, suffix):
+    if prefix is None:
+        return None
+    return (prefix + suffix).decode('utf8')
 
 
 class IssuePage(object):
+    __slots__ = ('thumbnail_url', 'url', 'width', 'height', 'size')
+
     def __init__(self):
         self.thumbnail_url = None
         self.url = None
@@ -27,13 +48,92 @@ class IssuePage(object):
         self.size = 0
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str(dict((n, getattr(self, n)) for n in IssuePage.__slots__))
+
+
+def _page_field(name, is_url=False):
+    # A property reading and writing one of the arrays of a `PageList`.
+    def _get(self):
+        value = getattr(self._pages, name)[self._index]
+        if is_url:
+            return _join_url(*value)
+        return value
+
+    def _set(self, value):
+        if is_url:
+            value = _split_url(value)
+        getattr(self._pages, name)[self._index] = value
+
+    return property(_get, _set)
+
+
+class _PageView(IssuePage):
+    # An `IssuePage` whose attributes live in a `PageList`.
+    __slots__ = ('_pages', '_index')
+
+    thumbnail_url = _page_field('_thumbnail_urls', True)
+    url = _page_field('_urls', True)
+    width = _page_field('_widths')
+    height = _page_field('_heights')
+    size = _page_field('_sizes')
+
+    def __init__(self, pages, index):
+        self._pages = pages
+        self._index = index
+
+
+class PageList(object):
+    """ A list of pages, stored as parallel arrays instead of one object
+        per page. Items are `IssuePage` views onto the stored values, so
+        setting their attributes updates the list.
+    """
+    __slots__ = ('_thumbnail_urls', '_urls', '_widths', '_heights', '_sizes')
+
+    def __init__(self):
+        self._thumbnail_urls = []
+        self._urls = []
+        self._widths = array.array('l')
+        self._heights = array.array('l')
+        self._sizes = array.array('l')
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __iter__(self):
+        for i in xrange(len(self._urls)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self._urls)
+        if not 0 <= idx < len(self._urls):
+            raise IndexError("page index out of range")
+        return _PageView(self, idx)
+
+    def __setitem__(self, idx, page):
+        self._thumbnail_urls[idx] = _split_url(page.thumbnail_url)
+        self._urls[idx] = _split_url(page.url)
+        self._widths[idx] = page.width
+        self._heights[idx] = page.height
+        self._sizes[idx] = page.size
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, page):
+        self._thumbnail_urls.append(_split_url(page.thumbnail_url))
+        self._urls.append(_split_url(page.url))
+        self._widths.append(page.width)
+        self._heights.append(page.height)
+        self._sizes.append(page.size)
 
 
 class ComixologyIssueMetadata(IssueMetadata):
+    __slots__ = ('pages',)
+
     def __init__(self):
         IssueMetadata.__init__(self)
-        self.pages = []
+        self.pages = PageList()
 
 
 class ComicsAccount(ServiceAccount):
@@ -59,10 +159,8 @@ class ComicsAccount(ServiceAccount):
                 'username': self.username,
                 'password': password
                 }
-        req = self._make_api_request(data)
-        resp = urllib2.urlopen(req)
-
-        result = json.loads(resp.read())
+        resp = self._make_api_request(data)
+        result = resp.json()
         if not 'account_info' in result:
             raise Exception("Error logging in: %s" % result['error']['message'])
         self.email = result['account_info']['email']
@@ -96,19 +194,18 @@ class ComicsAccount(ServiceAccount):
     def get_collection(self):
         self._check_logged_in()
 
-        result = self.cache.get('get_collection')
-        if result is None:
-            data = {
-                    'username': self.username,
-                    'password': self.password,
-                    'format': 'json',
-                    'action': 'getPurchasedSeries'
-                    }
-            req = self._make_api_request(data)
-            resp = urllib2.urlopen(req)
-            result = json.loads(resp.read())
-            self.cache.set('get_collection', result)
+        data = {
+                'username': self.username,
+                'password': self.password,
+                'format': 'json',
+                'action': 'getPurchasedSeries'
+                }
+        return self._get_cached_json(
+                'get_collection',
+                self._get_api_url(data),
+                parser=self._build_collection)
 
+    def _build_collection(self, result):
         collection = Collection()
 
         for item in result['items']:
@@ -137,20 +234,19 @@ class ComicsAccount(ServiceAccount):
     def _get_issues(self, series_id):
         self._check_logged_in()
 
-        result = self.cache.get('get_series_%s' % series_id)
-        if result is None:
-            data = {
-                    'username': self.username,
-                    'password': self.password,
-                    'format': 'json',
-                    'action': 'getPurchasedIssuesForSeries',
-                    'seriesid': series_id
-                    }
-            req = self._make_api_request(data)
-            resp = urllib2.urlopen(req)
-            result = json.loads(resp.read())
-            self.cache.set('get_series_%s' % series_id, result)
+        data = {
+                'username': self.username,
+                'password': self.password,
+                'format': 'json',
+                'action': 'getPurchasedIssuesForSeries',
+                'seriesid': series_id
+                }
+        return self._get_cached_json(
+                'get_series_%s' % series_id,
+                self._get_api_url(data),
+                parser=self._build_issues)
 
+    def _build_issues(self, result):
         issues = []
         for item in result['items']:
             issue = Issue()
@@ -168,19 +264,16 @@ class ComicsAccount(ServiceAccount):
     def _get_issue_metadata(self, comic_id):
         self._check_logged_in()
 
-        item = self.cache.get('get_issue_%s' % comic_id)
-        if item is None:
-            data = {
-                    'username': self.username,
-                    'password': self.password,
-                    'format': 'json',
-                    'action': 'getUserPurchase',
-                    'item_id': comic_id
-                    }
-            req = self._make_api_request(data)
-            resp = urllib2.urlopen(req)
-            item = json.loads(resp.read())
-            self.cache.set('get_issue_%s' % comic_id, item)
+        data = {
+                'username': self.username,
+                'password': self.password,
+                'format': 'json',
+                'action': 'getUserPurchase',
+                'item_id': comic_id
+                }
+        item = self._get_cached_json(
+                'get_issue_%s' % comic_id,
+                self._get_api_url(data))
 
         item_info = item['issue_info']
 
@@ -233,21 +326,26 @@ class ComicsAccount(ServiceAccount):
         return issue
 
     def get_issue_downloader(self, issue, ctx):
-        downloader = PagesIssueDownloader(issue, ctx)
+        if ctx.jobs is None:
+            ctx.jobs = COMIXOLOGY_PAGE_JOBS
+        downloader = PagesIssueDownloader(issue, ctx, self.session)
         return downloader
 
     def _check_logged_in(self):
         if self.password == None:
             raise Exception("You must login.")
 
-    def _make_api_request(self, data):
-        api_url = COMIXOLOGY_API_URL.format(
+    def _get_api_url(self, data):
+        return COMIXOLOGY_API_URL.format(
                 COMIXOLOGY_API_NAMES[self.api_name],
                 COMIXOLOGY_API_VERSION,
                 urllib.urlencode(data)
                 )
-        req = urllib2.Request(api_url)
-        return req
+
+    def _make_api_request(self, data):
+        resp = self.session.get(self._get_api_url(data))
+        resp.raise_for_status()
+        return resp
 
 
 class CDN(object):
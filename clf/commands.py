@@ -2,11 +2,18 @@ import re
 import os.path
 import pprint
 import progressbar
+import benchmarks
 from flask.ext.script import prompt, prompt_pass
 from auth import UserAccount, get_service_classes, get_service_class
 from clf import app, manager, cache_dir
-from cbz import CbzBuilder, CbzLibrary
+from cache import (Cache, JsonFileStore, SqliteStore, SQLITE_STORE_NAME, get_store_backends,
+        migrate_store)
+from cbz import CbzBuilder, CbzLibrary, CompressionPolicy
+from comic import iter_loaded_volumes, get_fields
 from downloader import DownloadProgress
+from prefetch import Prefetcher, DEFAULT_PREFETCH_JOBS, DEFAULT_PREFETCH_RATE
+from pipeline import SyncPipeline, SyncProgress, run_per_service
+from search import SearchIndex, SEARCH_INDEX_NAME
 
 
 # Command functions
@@ -63,7 +70,8 @@ def login(username=None, password=None, service=None):
 @manager.option('-i', '--id', dest='series_id', default=None)
 @manager.option('-v', '--vid', dest='volume_id', default=None)
 @manager.option('-p', '--path', dest='print_path', default=False, action='store_true')
-def list(query=None, service_name=None, series_id=None, volume_id=None, print_path=False):
+@manager.option('--fulltext', dest='fulltext', default=False, action='store_true')
+def list(query=None, service_name=None, series_id=None, volume_id=None, print_path=False, fulltext=False):
     ''' Lists series or issues.
     '''
     service = _get_service_safe(service_name)
@@ -76,19 +84,19 @@ def list(query=None, service_name=None, series_id=None, volume_id=None, print_pa
                 app.logger.info(" > %s" % library.get_issue_path(issue))
 
     if series_id is not None:
-        vols = _get_filtered_volumes(service, query, series_id)
+        vols = _get_filtered_volumes(service, query, series_id, fulltext=fulltext)
         vols = sorted(vols, key=lambda s: s.title)
         for vol in vols:
             app.logger.info("[%s] %s" % (vol.volume_id, vol.get_display_title()))
             print_paths(vol)
     elif volume_id is not None:
-        issues = _get_filtered_issues(service, query, volume_id=volume_id)
+        issues = _get_filtered_issues(service, query, volume_id=volume_id, fulltext=fulltext)
         issues = sorted(issues, key=lambda s: s.title)
         for issue in issues:
             app.logger.info("[%s] %s" % (issue.comic_id, issue.get_display_title()))
             print_paths(issue)
     else:
-        series = _get_filtered_series(service, query)
+        series = _get_filtered_series(service, query, fulltext=fulltext)
         series = sorted(series, key=lambda s: s.title)
         for s in series:
             app.logger.info("[%s] %s (%s issues)" % (s.series_id, s.get_display_title(), s.issue_count))
@@ -98,11 +106,12 @@ def list(query=None, service_name=None, series_id=None, volume_id=None, print_pa
 @manager.option('query', nargs='?', default=None)
 @manager.option('-s', '--service', dest='service_name', default=None)
 @manager.option('-i', '--id', dest='series_id', default=None)
-def price(query=None, service_name=None, series_id=None):
+@manager.option('--fulltext', dest='fulltext', default=False, action='store_true')
+def price(query=None, service_name=None, series_id=None, fulltext=False):
     ''' Gives the total price of the specified series or issues.
     '''
     service = _get_service_safe(service_name)
-    issues = _get_filtered_issues(service, query, series_id)
+    issues = _get_filtered_issues(service, query, series_id, fulltext=fulltext)
 
     total_price = 0
     paid_count = 0
@@ -122,10 +131,18 @@ def price(query=None, service_name=None, series_id=None):
 @manager.option('-s', '--service', dest='service_name', default=None)
 @manager.option('-o', '--output', dest='output', default=None)
 @manager.option('--metadata-only', dest='metadata_only', default=False, action='store_true')
-def download(issue_id, service_name=None, output=None, metadata_only=False):
+@manager.option('-j', '--jobs', dest='jobs', default=None, type=int)
+@manager.option('--pool-size', dest='pool_size', default=None, type=int)
+@manager.option('--compress-images', dest='compress_images', default=False, action='store_true')
+@manager.option('--compress-level', dest='compress_level', default=None, type=int)
+@manager.option('--no-fsync', dest='no_fsync', default=False, action='store_true')
+def download(issue_id, service_name=None, output=None, metadata_only=False, jobs=None, pool_size=None,
+        compress_images=False, compress_level=None, no_fsync=False):
     ''' Downloads comicbook issues.
     '''
     service = _get_service_safe(service_name)
+    if pool_size is not None:
+        service.set_pool_size(pool_size)
 
     issue = service.get_issue(issue_id)
     app.logger.info("[%s] %s" % (issue.comic_id, issue.get_display_title()))
@@ -136,7 +153,9 @@ def download(issue_id, service_name=None, output=None, metadata_only=False):
         output = library.get_issue_path(issue)
     out_path = output.strip('\'" ')
 
-    builder = CbzBuilder(service, subscriber=CliDownloadProgress(), temp_folder=cache_dir)
+    builder = CbzBuilder(service, subscriber=CliDownloadProgress(), temp_folder=cache_dir, jobs=jobs,
+            compression=CompressionPolicy(compress_images, compress_level),
+            fsync=(not no_fsync))
     builder.username = service.username
     if metadata_only:
         builder.update(issue, out_path=out_path)
@@ -144,6 +163,7 @@ def download(issue_id, service_name=None, output=None, metadata_only=False):
     else:
         builder.save(issue, out_path=out_path)
         app.logger.info("Issue saved at: %s" % out_path)
+    _log_connection_stats(service)
 
 
 @manager.option('query', nargs='?', default=None)
@@ -152,43 +172,194 @@ def download(issue_id, service_name=None, output=None, metadata_only=False):
 @manager.option('--new-only', dest='new_only', default=False, action='store_true')
 @manager.option('--metadata-only', dest='metadata_only', default=False, action='store_true')
 @manager.option('--library-dir', dest='lib_dir', default=None)
-def sync(query=None, service_name=None, series_id=None, new_only=False, metadata_only=False, lib_dir=None):
+@manager.option('-j', '--jobs', dest='jobs', default=None, type=int)
+@manager.option('--pool-size', dest='pool_size', default=None, type=int)
+@manager.option('--compress-images', dest='compress_images', default=False, action='store_true')
+@manager.option('--compress-level', dest='compress_level', default=None, type=int)
+@manager.option('--no-fsync', dest='no_fsync', default=False, action='store_true')
+@manager.option('--fulltext', dest='fulltext', default=False, action='store_true')
+@manager.option('--download-jobs', dest='download_jobs', default=None, type=int,
+        help="Number of issues downloaded at the same time.")
+@manager.option('--package-jobs', dest='package_jobs', default=None, type=int,
+        help="Number of issues packaged at the same time.")
+@manager.option('--all-services', dest='all_services', default=False, action='store_true',
+        help="Sync all the connected services at the same time.")
+@manager.option('--rate', dest='rate', default=None, type=float,
+        help="Maximum number of requests per second, to each service.")
+def sync(query=None, service_name=None, series_id=None, new_only=False, metadata_only=False, lib_dir=None, jobs=None, pool_size=None,
+        compress_images=False, compress_level=None, no_fsync=False, fulltext=False,
+        download_jobs=None, package_jobs=None, all_services=False, rate=None):
     ''' Synchronizes the local comicbook library with the connected or specified services.
     '''
     if query is not None and series_id is not None:
         raise Exception("Can't specify both a query and a series ID.")
 
-    service = _get_service_safe(service_name)
+    account = _get_account()
+    if all_services:
+        if service_name is not None or series_id is not None:
+            raise Exception("Can't specify a service or a series ID with --all-services.")
+        services = account.services.values()
+        if not services:
+            raise Exception("No connected services.")
+    else:
+        services = [_get_service_safe(service_name, account=account)]
 
     if lib_dir is None:
-        account = _get_account()
         lib_dir = account.library_path
     out_path = lib_dir.strip('\'" ')
+    # All the services share the library, and its index.
     library = CbzLibrary(out_path)
+    _remove_stale_temp_files(library)
+    progress = SyncProgress(CliDownloadProgress())
+
+    def _sync_service(service):
+        # Each service has its own connection pool and rate limiter.
+        if pool_size is not None:
+            service.set_pool_size(pool_size)
+        if rate is not None:
+            service.set_rate_limit(rate)
+        issues = _get_sync_issues(service, query, series_id, fulltext)
+
+        app.logger.info("Syncing issues from %s..." % service.service_label)
+        builder = CbzBuilder(service, temp_folder=cache_dir, jobs=jobs,
+                compression=CompressionPolicy(compress_images, compress_level),
+                fsync=(not no_fsync))
+        builder.username = service.username
+        pipeline = SyncPipeline(library, builder,
+                download_jobs=download_jobs,
+                package_jobs=package_jobs,
+                progress=progress)
+        stats = pipeline.sync(issues,
+                new_only=new_only,
+                metadata_only=metadata_only)
+        return (pipeline.get_stats_summary(), stats['failed'])
+
+    if len(services) == 1:
+        results = {services[0].service_name: _sync_service(services[0])}
+    else:
+        results = run_per_service(services, _sync_service)
+    progress.finish()
 
-    if series_id is None:
-        if query is None:
-            app.logger.info("Getting all issues from %s..." % service.service_label)
-            issues = service.get_collection().get_issues()
-        else:
-            issues = []
-            query = query.strip('\'" ')
-            collection = service.get_collection()
-            for series in collection:
-                if not re.search(query, series.get_display_title(), re.IGNORECASE):
-                    continue
-                app.logger.info("Getting issues from %s for: %s" % (service.service_label, series.get_display_title()))
-                issues += series.get_issues()
+    for service in services:
+        result = results.get(service.service_name)
+        if result is None:
+            app.logger.error("%s: sync failed." % service.service_label)
+            continue
+        summary, failed = result
+        app.logger.info("%s sync summary: %s" % (service.service_label, summary))
+        if failed:
+            app.logger.error("%s failed issues: %s" % (service.service_label, ', '.join(failed)))
+        _update_search_index(service)
+        _log_connection_stats(service)
+
+
+@manager.option('--library-dir', dest='lib_dir', default=None)
+@manager.option('-j', '--jobs', dest='jobs', default=8, type=int)
+def reindex(lib_dir=None, jobs=8):
+    ''' Rebuilds the index of the local comicbook library.
+    '''
+    if lib_dir is None:
+        account = _get_account()
+        lib_dir = account.library_path
+    library = CbzLibrary(lib_dir.strip('\'" '))
+    app.logger.info("Indexing library at: %s" % library.root_path)
+    count = library.index.rebuild(library.root_path, workers=jobs)
+    app.logger.info("Indexed %d issues." % count)
+    _remove_stale_temp_files(library)
+
+
+@manager.option('action', choices=['stats', 'gc', 'migrate'])
+@manager.option('--quota', dest='quota', default=None, type=int,
+        help="Total disk quota for the cache, in MB.")
+@manager.option('--keep', dest='keep', default=False, action='store_true')
+def cache(action, quota=None, keep=False):
+    ''' Manages the request cache.
+    '''
+    if action == 'migrate':
+        for name, service_cache_dir in _get_service_cache_dirs():
+            source = JsonFileStore(service_cache_dir)
+            destination = SqliteStore(os.path.join(service_cache_dir, SQLITE_STORE_NAME))
+            migrated = migrate_store(source, destination)
+            destination.close()
+            if not keep:
+                # Whatever couldn't be migrated stays where it is.
+                for key in migrated:
+                    source.delete(key)
+            app.logger.info("%s: migrated %d entries." % (name, len(migrated)))
+        return
+
+    # Open every store that holds entries, since a partial migration
+    # leaves some in both.
+    service_caches = []
+    for n, d in _get_service_cache_dirs():
+        backends = get_store_backends(d)
+        for b in backends:
+            label = n
+            if len(backends) > 1:
+                label = "%s (%s)" % (n, b)
+            service_caches.append((label, Cache(d, backend=b)))
+    usages = dict((n, c.get_disk_usage()) for n, c in service_caches)
+    total_size = sum(u['size'] for u in usages.itervalues())
+
+    for name, service_cache in service_caches:
+        if action == 'stats':
+            usage = usages[name]
+            app.logger.info("%s: %d entries (%d expired), %.1f MB" % (
+                    name, usage['entries'], usage['expired'], usage['size'] / (1024.0 * 1024.0)))
+        elif action == 'gc':
+            # The quota is shared between services in proportion to
+            # their current size.
+            service_quota = None
+            if quota is not None and total_size > 0:
+                service_quota = quota * 1024 * 1024 * usages[name]['size'] / total_size
+            result = service_cache.sweep(service_quota)
+            service_cache.store.compact()
+            app.logger.info("%s: dropped %d expired and %d evicted entries, reclaimed %.1f MB" % (
+                    name, result['expired'], result['evicted'],
+                    result['reclaimed'] / (1024.0 * 1024.0)))
+
+
+@manager.command
+def benchmark(name, issues=5000, backend='sqlite'):
+    ''' Runs a benchmark on a synthetic collection.
+    '''
+    if name == 'cache':
+        results = benchmarks.bench_cache_compression(int(issues), backend)
+        for r in results:
+            app.logger.info("%s: wrote in %.2fs, loaded in %.2fs, %.1f MB on disk" % (
+                    r['label'], r['write_time'], r['load_time'],
+                    r['disk_size'] / (1024.0 * 1024.0)))
+    elif name == 'model':
+        results = benchmarks.bench_model_memory(int(issues))
+        for r in results:
+            app.logger.info("%s: built in %.2fs, %.1f MB" % (
+                    r['label'], r['build_time'], r['size'] / (1024.0 * 1024.0)))
     else:
-        app.logger.info("Getting issues from %s for series ID %s" % (service.service_label, series_id))
-        issues = service.get_collection().get_series(series_id).get_issues()
+        raise Exception("No such benchmark: %s" % name)
 
-    app.logger.info("Syncing issues...")
-    builder = CbzBuilder(service, subscriber=CliDownloadProgress(), temp_folder=cache_dir)
-    builder.username = service.username
-    library.sync_issues(builder, issues, 
-            new_only=new_only,
-            metadata_only=metadata_only)
+
+@manager.option('query', nargs='?', default=None)
+@manager.option('-s', '--service', dest='service_name', default=None)
+@manager.option('-j', '--jobs', dest='jobs', default=DEFAULT_PREFETCH_JOBS, type=int)
+@manager.option('--rate', dest='rate', default=DEFAULT_PREFETCH_RATE, type=float)
+@manager.option('--no-metadata', dest='no_metadata', default=False, action='store_true')
+def prefetch(query=None, service_name=None, jobs=DEFAULT_PREFETCH_JOBS, rate=DEFAULT_PREFETCH_RATE,
+        no_metadata=False):
+    ''' Loads the issue lists and metadata of the specified series into the cache.
+    '''
+    service = _get_service_safe(service_name)
+    if jobs > service.pool_size:
+        service.set_pool_size(jobs)
+    service.set_rate_limit(rate)
+
+    series = [s for s in _get_filtered_series(service, query)]
+    app.logger.info("Prefetching %d series from %s..." % (len(series), service.service_label))
+    prefetcher = Prefetcher(service, jobs=jobs, subscriber=CliDownloadProgress())
+    stats = prefetcher.prefetch(series, metadata=(not no_metadata))
+    app.logger.info("Prefetched %d volumes and %d issues in %.1fs (%d errors)." % (
+            stats['volumes'], stats['issues'], stats['time'], stats['errors']))
+    _update_search_index(service)
+    _log_connection_stats(service)
 
 
 @manager.command
@@ -208,7 +379,7 @@ def print_issue(issue_id, service_name=None):
     service = _get_service_safe(service_name)
     issue = service.get_issue(issue_id)
     pp = pprint.PrettyPrinter(indent=4)
-    pp.pprint(issue.__dict__)
+    pp.pprint(get_fields(issue))
 
 
 # Helper functions
@@ -244,6 +415,30 @@ def _get_account():
     return ua
 
 
+def _log_connection_stats(service):
+    stats = service.get_connection_stats()
+    app.logger.info("%s: %d requests, %d connections opened, %d reused." % (
+            service.service_label,
+            stats['requests'],
+            stats['connections_opened'],
+            stats['connections_reused']))
+    fetches = service.cache.get_stats().get('fetches')
+    if fetches and fetches['coalesced']:
+        app.logger.info("%s: %d API fetches saved by coalescing." % (
+                service.service_label,
+                fetches['coalesced']))
+
+
+def _get_service_cache_dirs():
+    reqs_dir = os.path.join(cache_dir, 'reqs')
+    if not os.path.isdir(reqs_dir):
+        return
+    for name in sorted(os.listdir(reqs_dir)):
+        path = os.path.join(reqs_dir, name)
+        if os.path.isdir(path):
+            yield (name, path)
+
+
 def _prompt_index(message, default=1, min_val=1, max_val=10):
     choice = prompt(message, default=str(default))
     choice = int(choice)
@@ -269,8 +464,9 @@ def _get_service_class_safe(service_name, message="Choose the service for this c
         raise Exception("No such service: %s" % service_name)
 
 
-def _get_service_safe(service_name, message="Choose the service for this command:"):
-    account = _get_account()
+def _get_service_safe(service_name, message="Choose the service for this command:", account=None):
+    if account is None:
+        account = _get_account()
     if service_name is None:
         app.logger.info(message)
         names = account.services.keys()
@@ -288,48 +484,177 @@ def _get_service_safe(service_name, message="Choose the service for this command
         raise Exception("No such service: %s" % service_name)
 
 
-def _get_filtered_series(service, query=None):
-    pattern = None
-    if query:
-        pattern = query.strip('\'" ')
+class _TitleQuery(object):
+    """ Matches display titles against a regular expression.
+    """
+    def __init__(self, query):
+        self.pattern = re.compile(query, re.IGNORECASE)
 
+    def match_series(self, series):
+        return self.pattern.search(series.get_display_title())
+
+    def match_volume(self, vol):
+        return self.pattern.search(vol.get_display_title())
+
+    def match_issue(self, issue):
+        return self.pattern.search(issue.get_display_title())
+
+    def may_contain_matches(self, vol):
+        return True
+
+
+class _FulltextQuery(object):
+    """ Matches the results of a search index query.
+    """
+    def __init__(self, matches):
+        self.series_ids = set(m[0] for m in matches)
+        self.volume_ids = set(m[1] for m in matches)
+        # Volumes whose own title matched, with all their issues.
+        self.whole_volume_ids = set(m[1] for m in matches if m[2] is None)
+        # The volume of each matching issue, by comic ID.
+        self.issue_volume_ids = dict((m[2], m[1]) for m in matches if m[2] is not None)
+        self.comic_ids = set(self.issue_volume_ids)
+
+    def match_series(self, series):
+        return unicode(series.series_id) in self.series_ids
+
+    def match_volume(self, vol):
+        return unicode(vol.volume_id) in self.volume_ids
+
+    def match_issue(self, issue):
+        return (unicode(issue.comic_id) in self.comic_ids or
+                unicode(issue.parent.volume_id) in self.whole_volume_ids)
+
+    def may_contain_matches(self, vol):
+        return self.match_volume(vol)
+
+
+def _compile_query(query, service=None, fulltext=False):
+    if query is None:
+        return None
+    query = query.strip('\'" ')
+    if fulltext:
+        # Searching only reads the index. It's updated by the commands
+        # that load things from the service anyway, like `sync`.
+        index = SearchIndex(os.path.join(cache_dir, SEARCH_INDEX_NAME))
+        try:
+            if not index.has_docs(service.service_name):
+                app.logger.warning("Nothing from %s is in the search index yet, "
+                        "run `prefetch` or `sync` first." % service.service_label)
+            return _FulltextQuery(index.search(service.service_name, query))
+        finally:
+            index.close()
+    return _TitleQuery(query)
+
+
+def _remove_stale_temp_files(library):
+    count = library.remove_stale_temp_files()
+    if count:
+        app.logger.info("Removed %d temporary files left by interrupted syncs." % count)
+
+
+def _get_sync_issues(service, query=None, series_id=None, fulltext=False):
+    if series_id is not None:
+        app.logger.info("Getting issues from %s for series ID %s" % (service.service_label, series_id))
+        return service.get_collection().get_series(series_id).get_issues()
+    if query is None:
+        app.logger.info("Getting all issues from %s..." % service.service_label)
+        return service.get_collection().iter_issues()
+    if fulltext:
+        app.logger.info("Searching issues from %s for: %s" % (service.service_label, query))
+        return [i for i in _get_filtered_issues(service, query, fulltext=True)]
+
+    volumes = []
+    matcher = _compile_query(query)
     collection = service.get_collection()
     for series in collection:
-        if pattern and not re.search(pattern, series.get_display_title(), re.IGNORECASE):
+        if not matcher.match_series(series):
+            continue
+        app.logger.info("Getting issues from %s for: %s" % (service.service_label, series.get_display_title()))
+        volumes += series.volumes
+    return [i for v in iter_loaded_volumes(volumes) for i in v.issues]
+
+
+def _update_search_index(service):
+    """ Updates the search index with what's currently loaded from the
+        given service, and remembers where its issues are so that the
+        search results can be found without loading whole volumes.
+    """
+    collection = service.get_collection()
+    service.update_issue_locations(collection)
+    index = SearchIndex(os.path.join(cache_dir, SEARCH_INDEX_NAME))
+    try:
+        updated = index.update(service.service_name, collection)
+    finally:
+        index.close()
+    if updated:
+        app.logger.debug("Updated %d search index entries for %s." % (updated, service.service_label))
+
+
+def _get_filtered_series(service, query=None, fulltext=False):
+    matcher = _compile_query(query, service, fulltext)
+
+    collection = service.get_collection()
+    for series in collection:
+        if matcher and not matcher.match_series(series):
             continue
         yield series
 
 
-def _get_filtered_volumes(service, query=None, series_id=None):
-    pattern = None
-    if query:
-        pattern = query.strip('\'" ')
+def _get_filtered_volumes(service, query=None, series_id=None, fulltext=False):
+    matcher = _compile_query(query, service, fulltext)
 
     collection = service.get_collection()
     if series_id:
         collection = filter(lambda s: s.series_id == series_id, collection)
     for series in collection:
         for vol in series.volumes:
-            if pattern and not re.search(pattern, vol.get_display_title(), re.IGNORECASE):
+            if matcher and not matcher.match_volume(vol):
                 continue
             yield vol
 
 
-def _get_filtered_issues(service, query=None, series_id=None, volume_id=None):
-    pattern = None
-    if query:
-        pattern = query.strip('\'" ')
+def _get_fulltext_issues(service, matcher, volumes):
+    # The index says which issues matched, so they're looked up by ID
+    # instead of loading every volume they could be in. Only volumes
+    # whose own title matched are loaded whole.
+    volume_ids = set(unicode(v.volume_id) for v in volumes)
+    whole_volumes = [v for v in volumes if unicode(v.volume_id) in matcher.whole_volume_ids]
+    for vol in iter_loaded_volumes(whole_volumes):
+        for issue in vol.issues:
+            yield issue
+    for comic_id, volume_id in sorted(matcher.issue_volume_ids.iteritems()):
+        if volume_id not in volume_ids or volume_id in matcher.whole_volume_ids:
+            continue
+        issue = service.get_issue(comic_id, load_all=False)
+        if issue is None:
+            app.logger.warning("Can't find issue %s, the search index may be out of date." % comic_id)
+            continue
+        yield issue
+
+
+def _get_filtered_issues(service, query=None, series_id=None, volume_id=None, fulltext=False):
+    matcher = _compile_query(query, service, fulltext)
 
     collection = service.get_collection()
     if series_id:
         collection = filter(lambda s: s.series_id == series_id, collection)
+    volumes = []
     for series in collection:
-        volumes = series.volumes
         if volume_id:
-            volumes = filter(lambda v: v.volume_id == volume_id, volumes)
-        for vol in volumes:
-            for issue in vol.issues:
-                if pattern and not re.search(pattern, issue.get_display_title(), re.IGNORECASE):
-                    continue
-                yield issue
+            volumes += filter(lambda v: v.volume_id == volume_id, series.volumes)
+        else:
+            volumes += series.volumes
+    if isinstance(matcher, _FulltextQuery):
+        for issue in _get_fulltext_issues(service, matcher, volumes):
+            yield issue
+        return
+    if matcher:
+        # Don't load volumes that can't have any matching issue.
+        volumes = [v for v in volumes if matcher.may_contain_matches(v)]
+    for vol in iter_loaded_volumes(volumes):
+        for issue in vol.issues:
+            if matcher and not matcher.match_issue(issue):
+                continue
+            yield issue
 
@@ -1,6 +1,5 @@
 import os
 import re
-import requests
 import simplejson as json
 import os.path
 from service import ServiceAccount
@@ -12,6 +11,8 @@ DARKHORSE_API_URL = 'https://digital.darkhorse.com/api/v5/'
 
 
 class DarkHorseIssueMetadata(IssueMetadata):
+    __slots__ = ('request_factory',)
+
     def __init__(self):
         IssueMetadata.__init__(self)
         self.request_factory = None
@@ -29,7 +30,7 @@ class DarkHorseAccount(ServiceAccount):
     def login(self, password):
         print "Logging in as '%s'..." % self.username
         url = self._get_api_url('test_authentication')
-        r = requests.get(url, auth=(self.username, password))
+        r = self.session.get(url, auth=(self.username, password))
         r.raise_for_status()
 
         self.password = password
@@ -53,14 +54,14 @@ class DarkHorseAccount(ServiceAccount):
         self.friendlyname = cookie['friendlyname']
 
     def get_collection(self):
-        result = self.cache.get('get_collection')
-        if result is None:
-            url = self._get_api_url('collection/brands/')
-            r = requests.get(url, params={'depth': 3}, auth=self._get_auth())
-            r.raise_for_status()
-            result = r.json()
-            self.cache.set('get_collection', result)
-
+        return self._get_cached_json(
+                'get_collection',
+                self._get_api_url('collection/brands/'),
+                parser=self._build_collection,
+                params={'depth': 3},
+                auth=self._get_auth())
+
+    def _build_collection(self, result):
         collection = Collection() 
 
         for item in result:
@@ -109,30 +110,34 @@ class DarkHorseAccount(ServiceAccount):
         return title
 
     def _get_issue_metadata(self, comic_id):
-        item = self.cache.get('get_issue_%s' % comic_id)
-        if item is None:
-            url = self._get_api_url('bookmanifest/%s' % comic_id)
-            r = requests.get(url, auth=self._get_auth())
-            r.raise_for_status()
-            item = r.json()
-            self.cache.set('get_issue_%s' % comic_id, item)
-
-        issue = IssueMetadata()
+        item = self._get_cached_json(
+                'get_issue_%s' % comic_id,
+                self._get_api_url('bookmanifest/%s' % comic_id),
+                auth=self._get_auth())
+
+        issue = DarkHorseIssueMetadata()
         issue.synopsis = item['description']
         #issue.version = item['version']
         issue.publisher = 'Dark Horse'
         url = self._get_api_url('book/%s' % comic_id)
-        def _get_archive_request():
-            return requests.get(url, auth=self._get_auth(), stream=True)
+        def _get_archive_request(headers=None):
+            return self.session.get(url, auth=self._get_auth(), stream=True, headers=headers)
         issue.request_factory = _get_archive_request
         return issue
 
     def get_issue_downloader(self, issue, ctx):
-        downloader = ArchiveIssueDownloader(issue, ctx)
+        downloader = ArchiveIssueDownloader(issue, ctx, self.session)
         downloader.manifest_builder = DarkHorseAccount._get_manifest
         downloader.cleaner = DarkHorseAccount._clean_download
+        downloader.streaming = True
+        downloader.manifest_name = 'manifest.json'
+        downloader.manifest_parser = DarkHorseAccount._get_page_order
         return downloader
 
+    @staticmethod
+    def _get_page_order(manifest):
+        return [p['src_image'] for p in manifest['pages']]
+
     @staticmethod
     def _get_manifest(ctx):
         folder = ctx.temp_folder
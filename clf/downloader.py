@@ -1,7 +1,15 @@
+import os
 import os.path
-import urllib
+import json
 import logging
 import tarfile
+from multiprocessing.pool import ThreadPool
+from net import ServiceSession
+
+
+PAGE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+STREAM_BUFFER_SIZE = 32 * 1024 * 1024
 
 
 class DownloadProgress(object):
@@ -44,18 +52,31 @@ class NullDownloadProgress(DownloadProgress):
 
 
 class DownloadContext(object):
-    def __init__(self, temp_folder, subscriber=None):
+    def __init__(self, temp_folder, subscriber=None, jobs=None):
         self.temp_folder = temp_folder
         if subscriber is None:
             subscriber = NullDownloadProgress()
         self.subscriber = subscriber
+        # Number of parallel fetches, or `None` to let the service decide.
+        self.jobs = jobs
         self.pages = []
+        # Indices of pages the builder already has from somewhere else.
+        self.skip_pages = set()
+        # Set by the builder when the downloader can stream pages
+        # straight into the output archive, as `page_writer(name, data)`.
+        self.page_writer = None
 
 
 class IssueDownloader(object):
-    def __init__(self, issue, ctx):
+    def __init__(self, issue, ctx, session=None):
+        if session is None:
+            session = ServiceSession()
         self.issue = issue
         self.ctx = ctx
+        self.session = session
+
+    def can_stream(self):
+        return False
 
     def download(self):
         raise NotImplementedError()
@@ -65,49 +86,97 @@ class IssueDownloader(object):
 
 
 class PagesIssueDownloader(IssueDownloader):
-    def __init__(self, issue, ctx):
-        IssueDownloader.__init__(self, issue, ctx)
+    def __init__(self, issue, ctx, session=None):
+        IssueDownloader.__init__(self, issue, ctx, session)
         if not hasattr(issue.metadata, 'pages'):
             raise Exception("No pages have been defined on the issue metadata.")
 
     def download(self):
-        page_count = len(self.issue.metadata.pages)
+        pages = self.issue.metadata.pages
+        todo = [(i, p) for i, p in enumerate(pages) if i not in self.ctx.skip_pages]
+        page_count = len(todo)
+        jobs = max(1, min(self.ctx.jobs or 1, page_count))
+
+        # Pages can finish in any order, so keep a slot for each one
+        # to preserve the reading order in `ctx.pages`. Skipped pages
+        # keep a `None` slot.
+        self.ctx.pages = [None] * len(pages)
+        pool = ThreadPool(jobs)
         try:
-            for idx, page in enumerate(self.issue.metadata.pages):
-                page_num = idx + 1
-                page_file = os.path.join(self.ctx.temp_folder, '%04d.jpg' % page_num)
-                urllib.urlretrieve(page.url, page_file)
-                self.ctx.pages.append(page_file)
-                self.ctx.subscriber.progress(100.0 * page_num / page_count, message="Downloading pages...")
+            done = 0
+            for idx, page_file in pool.imap_unordered(self._download_page, todo):
+                self.ctx.pages[idx] = page_file
+                done += 1
+                self.ctx.subscriber.progress(
+                        100.0 * done / page_count,
+                        message=("Downloading pages (%d/%d)..." % (done, page_count)))
             self.ctx.subscriber.progress(100)
         except Exception as e:
             message = "Couldn't download pages: %s" % e
             self.ctx.subscriber.error(message)
-            return
+            raise
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _download_page(self, args):
+        idx, page = args
+        page_file = os.path.join(self.ctx.temp_folder, '%04d.jpg' % (idx + 1))
+        # Pages left over by an interrupted download are kept if they
+        # are complete.
+        if (page.size > 0 and os.path.isfile(page_file) and
+                os.path.getsize(page_file) == page.size):
+            return (idx, page_file)
+
+        r = self.session.get(page.url, stream=True)
+        r.raise_for_status()
+        part_file = page_file + '.part'
+        with open(part_file, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=PAGE_CHUNK_SIZE):
+                f.write(chunk)
+        os.rename(part_file, page_file)
+        return (idx, page_file)
+
 
 class ArchiveIssueDownloader(IssueDownloader):
-    def __init__(self, issue, ctx):
-        IssueDownloader.__init__(self, issue, ctx)
+    def __init__(self, issue, ctx, session=None):
+        IssueDownloader.__init__(self, issue, ctx, session)
         if not hasattr(issue.metadata, 'request_factory'):
             raise Exception("No archive URL was defined on the issue metadata.")
         self.manifest_builder = None
         self.cleaner = None
+        # Streaming mode: `manifest_parser` returns the ordered page
+        # names from the manifest found at `manifest_name` in the archive.
+        self.streaming = False
+        self.manifest_name = None
+        self.manifest_parser = None
+        self.buffer_size = STREAM_BUFFER_SIZE
+
+    def can_stream(self):
+        return bool(self.streaming and self.manifest_name and self.manifest_parser)
 
     def download(self):
+        if self.ctx.page_writer is not None:
+            self._download_streaming()
+            return
+
         if not self.manifest_builder:
             raise Exception("No manifest builder was defined on this downloader.")
 
-        progress = 0
-        r = self.issue.metadata.request_factory()
-        r.raise_for_status()
-        content_length = int(r.headers['content-length'])
         temp_file = os.path.join(self.ctx.temp_folder, 'archive.tar')
-        with open(temp_file, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=(content_length / 9)):
-                self.ctx.subscriber.progress(progress, message="Downloading archive...")
-                if progress <= 90:
-                    progress += 10
-                f.write(chunk)
+        if not os.path.isfile(temp_file):
+            part_file = temp_file + '.part'
+            r, offset = self._open_archive(part_file)
+            total = offset + int(r.headers.get('content-length', 0))
+            with open(part_file, 'ab') as f:
+                for chunk in r.iter_content(chunk_size=ARCHIVE_CHUNK_SIZE):
+                    f.write(chunk)
+                    offset += len(chunk)
+                    if total > 0:
+                        self.ctx.subscriber.progress(
+                                90.0 * offset / total,
+                                message="Downloading archive...")
+            os.rename(part_file, temp_file)
 
         self.ctx.subscriber.progress(90, message="Extracting archive...")
         with tarfile.open(temp_file) as archive:
@@ -118,8 +187,168 @@ class ArchiveIssueDownloader(IssueDownloader):
 
         self.ctx.subscriber.progress(100)
 
+    def _download_streaming(self):
+        # The raw stream is also appended to a checkpoint file, so that
+        # an interrupted download can replay it and only fetch the rest.
+        part_file = os.path.join(self.ctx.temp_folder, 'archive.tar.part')
+        r, offset = self._open_archive(part_file)
+        total = offset + int(r.headers.get('content-length', 0))
+        reader = _ArchiveReader(r.raw, total, self.ctx.subscriber, part_file, offset)
+
+        # Pages are written in manifest order. Anything that arrives
+        # before its turn (or before the manifest itself) is held in
+        # a bounded buffer that spills to the temp folder.
+        pending = _PageBuffer(self.ctx.temp_folder, self.buffer_size)
+        positions = None
+        page_count = 0
+        next_page = 0
+        try:
+            archive = tarfile.open(fileobj=reader, mode='r|*')
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name = os.path.normpath(member.name)
+                if name == self.manifest_name:
+                    manifest = json.load(archive.extractfile(member))
+                    order = [os.path.normpath(n) for n in self.manifest_parser(manifest)]
+                    positions = dict((n, i) for i, n in enumerate(order))
+                    page_count = len(order)
+                    for n in pending.names():
+                        if n not in positions:
+                            pending.discard(n)
+                elif positions is None or name in positions:
+                    pending.add(name, archive.extractfile(member).read())
+
+                if positions is None:
+                    continue
+                while next_page < page_count and order[next_page] in pending:
+                    self.ctx.page_writer(
+                            '%04d.jpg' % next_page,
+                            pending.pop(order[next_page]))
+                    next_page += 1
+            archive.close()
+        finally:
+            reader.close()
+            pending.clear()
+
+        if positions is None:
+            raise Exception("No manifest was found in the archive.")
+        if next_page < page_count:
+            raise Exception("The archive is missing page: %s" % order[next_page])
+        self.ctx.subscriber.progress(100)
+
+    def _open_archive(self, part_file):
+        offset = 0
+        if os.path.isfile(part_file):
+            offset = os.path.getsize(part_file)
+        if offset > 0:
+            r = self.issue.metadata.request_factory(headers={'Range': 'bytes=%d-' % offset})
+            if r.status_code == 206:
+                return (r, offset)
+            os.remove(part_file)
+            if r.status_code != 416:
+                # The server ignored the range and is sending the
+                # whole archive again.
+                r.raise_for_status()
+                return (r, 0)
+            # The range was rejected, start over. The error body is
+            # drained so the connection goes back to the pool.
+            r.content
+        r = self.issue.metadata.request_factory()
+        r.raise_for_status()
+        return (r, 0)
+
     def cleanup(self):
-        os.remove(os.path.join(self.ctx.temp_folder, 'archive.tar'))
+        part_path = os.path.join(self.ctx.temp_folder, 'archive.tar.part')
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        archive_path = os.path.join(self.ctx.temp_folder, 'archive.tar')
+        if not os.path.isfile(archive_path):
+            return
+        os.remove(archive_path)
         if self.cleaner:
             self.cleaner(self.ctx)
 
+
+class _ArchiveReader(object):
+    def __init__(self, fp, total, subscriber, checkpoint_path, offset=0):
+        self.fp = fp
+        self.total = total
+        self.subscriber = subscriber
+        self.bytes_read = 0
+        self.replay = None
+        if offset > 0:
+            self.replay = open(checkpoint_path, 'rb')
+        self.checkpoint = open(checkpoint_path, 'ab')
+
+    def read(self, size=-1):
+        data = ''
+        if self.replay is not None:
+            data = self.replay.read() if size < 0 else self.replay.read(size)
+            if not data or (size >= 0 and len(data) < size):
+                self.replay.close()
+                self.replay = None
+        if self.replay is None and (size < 0 or len(data) < size):
+            remote = self.fp.read() if size < 0 else self.fp.read(size - len(data))
+            self.checkpoint.write(remote)
+            data += remote
+        self.bytes_read += len(data)
+        if self.total > 0:
+            self.subscriber.progress(
+                    min(99, 100.0 * self.bytes_read / self.total),
+                    message="Downloading archive...")
+        return data
+
+    def close(self):
+        if self.replay is not None:
+            self.replay.close()
+            self.replay = None
+        self.checkpoint.close()
+
+
+class _PageBuffer(object):
+    def __init__(self, spill_folder, max_size):
+        self.spill_folder = spill_folder
+        self.max_size = max_size
+        self.size = 0
+        self.in_memory = {}
+        self.on_disk = {}
+
+    def __contains__(self, name):
+        return name in self.in_memory or name in self.on_disk
+
+    def names(self):
+        return self.in_memory.keys() + self.on_disk.keys()
+
+    def add(self, name, data):
+        if self.size + len(data) <= self.max_size:
+            self.in_memory[name] = data
+            self.size += len(data)
+            return
+        path = os.path.join(self.spill_folder, 'pending_%04d' % len(self.on_disk))
+        while os.path.exists(path):
+            path += '_'
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.on_disk[name] = path
+
+    def pop(self, name):
+        if name in self.in_memory:
+            data = self.in_memory.pop(name)
+            self.size -= len(data)
+            return data
+        path = self.on_disk.pop(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        return data
+
+    def discard(self, name):
+        if name in self.in_memory:
+            self.size -= len(self.in_memory.pop(name))
+        elif name in self.on_disk:
+            os.remove(self.on_disk.pop(name))
+
+    def clear(self):
+        for name in self.names():
+            self.discard(name)
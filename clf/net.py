@@ -0,0 +1,80 @@
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_SIZE = 8
+
+
+class RateLimiter(object):
+    """ Spaces out calls so that there are at most `rate` of them per
+        second, across all threads.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.interval = 1.0 / rate
+        self._next_time = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class ServiceSession(object):
+    """ A keep-alive HTTP session with a bounded connection pool,
+        shared by all the API calls and page fetches of a service.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self.rate_limiter = None
+        self._session = requests.Session()
+        # `pool_block` makes threads wait for a free connection instead
+        # of opening (and throwing away) extra ones.
+        self._adapter = HTTPAdapter(
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+                pool_block=True)
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        return self._session.request(method, url, **kwargs)
+
+    def set_rate_limit(self, rate):
+        """ Limits the number of requests per second, or removes the
+            limit if `rate` is `None`.
+        """
+        self.rate_limiter = RateLimiter(rate) if rate else None
+
+    def get_stats(self):
+        """ Returns the number of requests made and connections
+            opened so far.
+        """
+        requests_made = 0
+        connections = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made += getattr(pool, 'num_requests', 0)
+            connections += getattr(pool, 'num_connections', 0)
+        return {
+                'requests': requests_made,
+                'connections_opened': connections,
+                'connections_reused': max(0, requests_made - connections)
+                }
+
+    def close(self):
+        self._session.close()
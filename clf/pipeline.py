@@ -0,0 +1,330 @@
+import os.path
+import time
+import Queue
+import logging
+import threading
+# `datetime.strptime` imports this on first use, which isn't thread-safe
+# on Python 2, and the workers build the issues' ComicBookInfo with it.
+import _strptime
+from downloader import NullDownloadProgress
+
+
+DEFAULT_DOWNLOAD_JOBS = 2
+DEFAULT_PACKAGE_JOBS = 2
+# How many issues can wait between two stages. Downloaded pages sit on
+# disk until they're packaged, so this also bounds the temporary space.
+DEFAULT_QUEUE_SIZE = 4
+
+_end_of_stage = object()
+
+
+def _put(queue, item):
+    while True:
+        try:
+            queue.put(item, True, 0.5)
+            return
+        except Queue.Full:
+            pass
+
+
+def run_per_service(services, func):
+    """ Calls `func(service)` for each of the given services, each on
+        its own thread, and returns the results by service name.
+        A service that fails is logged and gets a `None` result, and
+        doesn't stop the others.
+    """
+    logger = logging.getLogger(__name__)
+    results = {}
+
+    def _run(service):
+        try:
+            results[service.service_name] = func(service)
+        except Exception as e:
+            logger.error("%s: %s" % (service.service_label, e))
+            results[service.service_name] = None
+
+    threads = []
+    for service in services:
+        t = threading.Thread(target=_run, args=(service,),
+                name=('sync-%s' % service.service_name))
+        t.daemon = True
+        threads.append(t)
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(0.5)
+    return results
+
+
+class SyncProgress(object):
+    """ Reports the overall progress of one or more sync pipelines
+        to a single subscriber, so that services synced at the same
+        time share one progress display.
+    """
+    def __init__(self, subscriber=None):
+        if subscriber is None:
+            subscriber = NullDownloadProgress()
+        self.subscriber = subscriber
+        # Done and total issue counts, by name.
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts.setdefault(name, [0, 0])[1] += count
+
+    def done(self, name, count=1):
+        with self._lock:
+            self.counts[name][0] += count
+            done = sum(c[0] for c in self.counts.itervalues())
+            total = sum(c[1] for c in self.counts.itervalues())
+            # More issues may still be coming, so it's never finished
+            # until `finish` says so.
+            self.subscriber.progress(min(99, 100 * done / total), self._get_message())
+
+    def finish(self):
+        with self._lock:
+            self.subscriber.progress(100, self._get_message())
+
+    def _get_message(self):
+        return ', '.join("%s: %d/%d" % (name, c[0], c[1])
+                for name, c in sorted(self.counts.iteritems()))
+
+
+class _IssueProgress(NullDownloadProgress):
+    # With several issues in flight a progress bar doesn't make sense,
+    # so only the messages are logged, with the issue they're about.
+    def __init__(self, prefix, logger):
+        NullDownloadProgress.__init__(self, logger)
+        self.prefix = prefix
+
+    def error(self, message):
+        self.logger.error("%s: %s" % (self.prefix, message))
+
+    def warning(self, message):
+        self.logger.warning("%s: %s" % (self.prefix, message))
+
+    def info(self, message):
+        self.logger.info("%s: %s" % (self.prefix, message))
+
+    def debug(self, message):
+        self.logger.debug("%s: %s" % (self.prefix, message))
+
+
+class _SyncItem(object):
+    def __init__(self, issue, progress):
+        self.issue = issue
+        self.path = None
+        self.progress = progress
+        self.action = None
+        self.job = None
+
+
+class _Stage(object):
+    def __init__(self, name, func, workers, queue_size):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = Queue.Queue(queue_size)
+        self.next_stage = None
+        self.busy_time = 0.0
+        self.threads = []
+        self._running = 0
+        self._lock = threading.Lock()
+
+
+class SyncPipeline(object):
+    """ Syncs issues into a library in overlapping stages: figuring out
+        what needs to be done for each issue (which loads its metadata),
+        downloading its pages, and packaging them into a CBZ file.
+        Each stage has its own worker threads, with bounded queues in
+        between so that downloads don't get too far ahead of packaging.
+        An error with one issue is logged and counted, and doesn't stop
+        the others.
+    """
+    def __init__(self, library, builder, download_jobs=None, package_jobs=None,
+            queue_size=None, progress=None):
+        if download_jobs is None:
+            download_jobs = DEFAULT_DOWNLOAD_JOBS
+        if package_jobs is None:
+            package_jobs = DEFAULT_PACKAGE_JOBS
+        if queue_size is None:
+            queue_size = DEFAULT_QUEUE_SIZE
+        if progress is None:
+            progress = SyncProgress()
+        self.library = library
+        self.builder = builder
+        self.download_jobs = download_jobs
+        self.package_jobs = package_jobs
+        self.queue_size = queue_size
+        self.progress = progress
+        self.logger = logging.getLogger(__name__)
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def sync(self, issues, metadata_only=False, new_only=False, force=False):
+        """ Syncs the given issues, which can be a generator that's still
+            loading them. Returns statistics about the run.
+        """
+        self.stats = {
+                'issues': 0, 'new': 0, 'updated': 0, 'up_to_date': 0,
+                'errors': 0, 'failed': [], 'bytes_written': 0, 'package_time': 0,
+                'stage_times': {}, 'time': 0}
+        self._options = (metadata_only, new_only, force)
+        bytes_written = self.builder.stats['bytes_written']
+        package_time = self.builder.stats['package_time']
+        start = time.time()
+
+        # Metadata resolution is network bound too, so it gets as many
+        # workers as the downloads.
+        resolve = _Stage('resolve', self._resolve, self.download_jobs, self.queue_size)
+        download = _Stage('download', self._download, self.download_jobs, self.queue_size)
+        package = _Stage('package', self._package, self.package_jobs, self.queue_size)
+        resolve.next_stage = download
+        download.next_stage = package
+        self._download_stage = download
+        self._package_stage = package
+        stages = [resolve, download, package]
+        for stage in stages:
+            self._start_stage(stage)
+
+        try:
+            try:
+                for issue in issues:
+                    # Anything that could need the issue's metadata is
+                    # left to the resolve workers.
+                    progress = _IssueProgress("[%s]" % issue.comic_id, self.logger)
+                    self.progress.add(self.builder.service.service_name)
+                    _put(resolve.queue, _SyncItem(issue, progress))
+                    self.stats['issues'] += 1
+            except Exception as e:
+                # The issues that were already queued still get synced.
+                self.logger.error("Error getting the issues to sync: %s" % e)
+                with self._lock:
+                    self.stats['errors'] += 1
+            for i in range(resolve.workers):
+                _put(resolve.queue, _end_of_stage)
+            for stage in stages:
+                for t in stage.threads:
+                    # Waiting with a timeout keeps the main thread
+                    # responsive to Ctrl-C, here and in `_put`.
+                    while t.is_alive():
+                        t.join(0.5)
+        finally:
+            self.stats['time'] = time.time() - start
+            self.stats['bytes_written'] = self.builder.stats['bytes_written'] - bytes_written
+            self.stats['package_time'] = self.builder.stats['package_time'] - package_time
+            for stage in stages:
+                self.stats['stage_times'][stage.name] = stage.busy_time
+        return self.stats
+
+    def get_stats_summary(self):
+        stats = self.stats
+        synced = stats['new'] + stats['updated']
+        elapsed = max(stats['time'], 0.001)
+        megabytes = stats['bytes_written'] / (1024.0 * 1024.0)
+        return ("%d issues in %.1fs: %d new, %d updated, %d up-to-date, %d failed. "
+                "%.1f issues/min, %.1f MB written (%.2f MB/s), %.2fs writing archive entries. "
+                "Busy time: %.1fs resolving, %.1fs downloading, %.1fs packaging." % (
+                    stats['issues'], stats['time'],
+                    stats['new'], stats['updated'], stats['up_to_date'], stats['errors'],
+                    synced * 60.0 / elapsed, megabytes, megabytes / elapsed,
+                    stats['package_time'],
+                    stats['stage_times'].get('resolve', 0),
+                    stats['stage_times'].get('download', 0),
+                    stats['stage_times'].get('package', 0)))
+
+    def _start_stage(self, stage):
+        stage._running = stage.workers
+        for i in range(stage.workers):
+            t = threading.Thread(target=self._run_worker, args=(stage,),
+                    name=('sync-%s-%d' % (stage.name, i)))
+            t.daemon = True
+            stage.threads.append(t)
+            t.start()
+
+    def _run_worker(self, stage):
+        try:
+            while True:
+                item = stage.queue.get()
+                if item is _end_of_stage:
+                    break
+                start = time.time()
+                try:
+                    # Stage functions return the stage the item goes
+                    # to next, if any.
+                    next_stage = stage.func(item)
+                except Exception as e:
+                    self._add_failure(item, "%s failed: %s" % (stage.name, e))
+                    next_stage = None
+                with stage._lock:
+                    stage.busy_time += time.time() - start
+                if next_stage is not None:
+                    next_stage.queue.put(item)
+                else:
+                    self.progress.done(self.builder.service.service_name)
+        finally:
+            # The last worker out tells the next stage there's nothing
+            # more coming.
+            with stage._lock:
+                stage._running -= 1
+                last = (stage._running == 0)
+            if last and stage.next_stage is not None:
+                for i in range(stage.next_stage.workers):
+                    stage.next_stage.queue.put(_end_of_stage)
+
+    def _resolve(self, item):
+        item.progress.prefix = "[%s] %s" % (item.issue.comic_id, item.issue.get_display_title())
+        item.path = self.library.get_issue_path(item.issue)
+        metadata_only, new_only, force = self._options
+        action, reason = self.library.get_sync_action(item.issue, metadata_only, new_only, force)
+        if action is None:
+            if reason is not None:
+                item.progress.info("up-to-date (%s)" % reason)
+                self._add_stat('up_to_date')
+            return
+
+        item.action = action
+        # Load the metadata now, so that downloads only wait on pages.
+        item.issue.metadata
+        if action == 'new':
+            item.progress.info("downloading (new)")
+        else:
+            item.progress.info("syncing issue (reason: %s)" % reason)
+        if action == 'update':
+            # Nothing to download, the pages are already in the library.
+            return self._package_stage
+        return self._download_stage
+
+    def _download(self, item):
+        previous = None
+        if item.action == 'save':
+            previous = item.path
+        item.job = self.builder.download(item.issue, in_library=self.library,
+                previous=previous, subscriber=item.progress)
+        return self._package_stage
+
+    def _package(self, item):
+        if item.action == 'update':
+            self.builder.update(item.issue, in_library=self.library, subscriber=item.progress)
+        elif not self.builder.package(item.job):
+            # The builder already said why.
+            self._add_failure(item)
+            return
+        if os.path.isfile(item.path):
+            self.library.index.refresh(item.path)
+        if item.action == 'new':
+            self._add_stat('new')
+        else:
+            self._add_stat('updated')
+
+    def _add_stat(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _add_failure(self, item, message=None):
+        if message is not None:
+            item.progress.error(message)
+        with self._lock:
+            self.stats['errors'] += 1
+            self.stats['failed'].append(item.issue.comic_id)
@@ -0,0 +1,86 @@
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_PREFETCH_JOBS = 8
+# Requests per second, to stay polite with the services' APIs.
+DEFAULT_PREFETCH_RATE = 10
+
+
+class Prefetcher(object):
+    """ Warms up a service's cache by loading the issue lists and the
+        issue metadata of a collection with a pool of worker threads.
+    """
+    def __init__(self, service, jobs=None, subscriber=None):
+        if jobs is None:
+            jobs = DEFAULT_PREFETCH_JOBS
+        self.service = service
+        self.jobs = jobs
+        self.subscriber = subscriber
+        self.logger = logging.getLogger(__name__)
+
+    def prefetch(self, series=None, metadata=True):
+        """ Prefetches the given series, or the whole collection.
+            Returns statistics about what was loaded.
+        """
+        if series is None:
+            series = list(self.service.get_collection())
+        volumes = [v for s in series for v in s.volumes]
+        stats = {'volumes': len(volumes), 'issues': 0, 'errors': 0, 'time': 0}
+        start = time.time()
+
+        pool = ThreadPool(self.jobs)
+        try:
+            # Each issue is only ever loaded by one worker, so its lazy
+            # metadata loader doesn't need to be thread-safe.
+            issues = []
+            done = 0
+            for vol_issues in pool.imap_unordered(self._load_issues, volumes):
+                done += 1
+                if vol_issues is None:
+                    stats['errors'] += 1
+                else:
+                    issues += vol_issues
+                self._progress(done, len(volumes), 0, 20,
+                        "Loading issue lists (%d/%d)..." % (done, len(volumes)))
+            stats['issues'] = len(issues)
+
+            if metadata:
+                done = 0
+                for ok in pool.imap_unordered(self._load_metadata, issues):
+                    done += 1
+                    if not ok:
+                        stats['errors'] += 1
+                    self._progress(done, len(issues), 20, 80,
+                            "Loading issue metadata (%d/%d)..." % (done, len(issues)))
+        finally:
+            pool.close()
+            pool.join()
+        self.service.update_issue_locations(self.service.get_collection())
+        self.service.cache.flush()
+        self._progress(1, 1, 0, 100)
+
+        stats['time'] = time.time() - start
+        return stats
+
+    def _load_issues(self, volume):
+        try:
+            return list(volume.issues)
+        except Exception as e:
+            self.logger.error("Error loading issues for volume %s: %s" % (volume.volume_id, e))
+            return None
+
+    def _load_metadata(self, issue):
+        try:
+            issue.metadata
+            return True
+        except Exception as e:
+            self.logger.error("Error loading metadata for issue %s: %s" % (issue.comic_id, e))
+            return False
+
+    def _progress(self, done, total, offset, span, message=None):
+        if self.subscriber is None:
+            return
+        value = offset + span * done / max(1, total)
+        self.subscriber.progress(value, message)
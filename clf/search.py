@@ -0,0 +1,175 @@
+import re
+import os
+import os.path
+import sqlite3
+import hashlib
+import threading
+
+
+SEARCH_INDEX_NAME = 'search.sqlite'
+# How long to wait (in seconds) for another process writing to the index.
+SEARCH_INDEX_TIMEOUT = 30
+
+# Updates from different `SearchIndex` objects, like one per service
+# when syncing several at once, would otherwise fight over the database.
+_update_lock = threading.Lock()
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def _tokenize(text):
+    return set(w.lower() for w in _word_re.findall(text))
+
+
+def _get_volume_text(vol):
+    return u' '.join(unicode(t) for t in (
+            vol.parent.title,
+            vol.title,
+            vol.volume_num) if t)
+
+
+def _get_issue_text(issue):
+    parts = [_get_volume_text(issue.parent), issue.title, issue.num]
+    if issue.is_metadata_loaded:
+        metadata = issue.metadata
+        parts += [metadata.publisher, metadata.imprint, metadata.synopsis]
+        for names in metadata.creators.itervalues():
+            parts += names
+    return u' '.join(unicode(p) for p in parts if p)
+
+
+class SearchIndex(object):
+    """ A persistent inverted index of the words in the titles, creators,
+        publishers and synopses of the issues in the collections of the
+        connected services.
+        It's updated from whatever is already loaded, so that searching
+        never needs the network.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def update(self, service_name, collection):
+        """ Updates the documents of the given service's collection.
+            Only loaded volumes and issues are (re-)indexed. The ones
+            that aren't loaded keep the documents of previous updates.
+            Returns the number of updated documents.
+        """
+        with _update_lock, self._lock:
+            conn = self._get_conn()
+            existing = {}
+            by_volume = {}
+            for row in conn.execute(
+                    'SELECT id, volume_id, comic_id, signature, has_metadata FROM docs '
+                    'WHERE service=?', (service_name,)):
+                existing[(row[1], row[2])] = (row[0], row[3], row[4])
+                by_volume.setdefault(row[1], []).append((row[1], row[2]))
+
+            keep = set()
+            updated = 0
+            with conn:
+                for series in collection:
+                    for vol in series.volumes:
+                        volume_id = unicode(vol.volume_id)
+                        series_id = unicode(series.series_id)
+                        doc = (series_id, volume_id, u'')
+                        updated += self._update_doc(conn, service_name, doc,
+                                _get_volume_text(vol), False, existing, keep)
+                        if not vol.is_loaded:
+                            keep.update(by_volume.get(volume_id, ()))
+                            continue
+                        for issue in vol.issues:
+                            doc = (series_id, volume_id, unicode(issue.comic_id))
+                            key = doc[1:]
+                            if (not issue.is_metadata_loaded and
+                                    key in existing and existing[key][2]):
+                                # Don't lose what we know from metadata
+                                # loaded in a previous run.
+                                keep.add(key)
+                                continue
+                            updated += self._update_doc(conn, service_name, doc,
+                                    _get_issue_text(issue), issue.is_metadata_loaded,
+                                    existing, keep)
+
+                for key, (doc_id, signature, has_metadata) in existing.iteritems():
+                    if key not in keep:
+                        conn.execute('DELETE FROM postings WHERE doc=?', (doc_id,))
+                        conn.execute('DELETE FROM docs WHERE id=?', (doc_id,))
+                        updated += 1
+        return updated
+
+    def search(self, service_name, query):
+        """ Gets the `(series_id, volume_id, comic_id)` of the documents
+            matching all the words in the query, where words can be
+            prefixes. `comic_id` is `None` for volume documents.
+        """
+        if isinstance(query, str):
+            query = query.decode('utf8')
+        terms = _tokenize(query)
+        if not terms:
+            raise Exception("Nothing to search for in: %s" % query)
+        sql = 'SELECT series_id, volume_id, comic_id FROM docs WHERE service=?'
+        params = [service_name]
+        for term in terms:
+            # Prefix matching, with a range that can use the index.
+            sql += ' AND id IN (SELECT doc FROM postings WHERE term >= ? AND term < ?)'
+            params += [term, term + u'\uffff']
+        with self._lock:
+            rows = self._get_conn().execute(sql, params).fetchall()
+        return [(r[0], r[1], r[2] or None) for r in rows]
+
+    def has_docs(self, service_name):
+        with self._lock:
+            row = self._get_conn().execute(
+                    'SELECT 1 FROM docs WHERE service=? LIMIT 1', (service_name,)).fetchone()
+        return row is not None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _update_doc(self, conn, service_name, doc, text, has_metadata, existing, keep):
+        key = doc[1:]
+        keep.add(key)
+        signature = hashlib.sha1(text.encode('utf8')).hexdigest()
+        if key in existing:
+            doc_id, old_signature, old_has_metadata = existing[key]
+            if old_signature == signature:
+                return 0
+            conn.execute('DELETE FROM postings WHERE doc=?', (doc_id,))
+            conn.execute(
+                    'UPDATE docs SET series_id=?, signature=?, has_metadata=? WHERE id=?',
+                    (doc[0], signature, has_metadata, doc_id))
+        else:
+            doc_id = conn.execute(
+                    'INSERT INTO docs (service, series_id, volume_id, comic_id, signature, has_metadata) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (service_name, doc[0], doc[1], doc[2], signature, has_metadata)).lastrowid
+        conn.executemany(
+                'INSERT INTO postings (term, doc) VALUES (?, ?)',
+                [(t, doc_id) for t in _tokenize(text)])
+        return 1
+
+    def _get_conn(self):
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_path)
+            if db_dir and not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            self._conn = sqlite3.connect(self.db_path, timeout=SEARCH_INDEX_TIMEOUT,
+                    check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                        'CREATE TABLE IF NOT EXISTS docs ('
+                        'id INTEGER PRIMARY KEY, service TEXT, series_id TEXT, volume_id TEXT, '
+                        'comic_id TEXT, signature TEXT, has_metadata INTEGER, '
+                        'UNIQUE (service, volume_id, comic_id))')
+                self._conn.execute(
+                        'CREATE TABLE IF NOT EXISTS postings (term TEXT, doc INTEGER)')
+                self._conn.execute(
+                        'CREATE INDEX IF NOT EXISTS postings_term ON postings (term)')
+                self._conn.execute(
+                        'CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc)')
+        return self._conn
@@ -1,4 +1,7 @@
-from cache import DummyCache
+import threading
+import datetime
+from cache import DummyCache, NOT_MODIFIED
+from net import ServiceSession, DEFAULT_POOL_SIZE
 
 
 class ServiceAccount(object):
@@ -6,10 +9,49 @@ class ServiceAccount(object):
     """
     service_name = None
     service_label = None
+    # (key prefix, lifetime, stale lifetime) of the cached API responses.
+    cache_policies = [
+            ('get_collection', datetime.timedelta(hours=1), datetime.timedelta(days=7)),
+            ('get_series_', datetime.timedelta(hours=6), datetime.timedelta(days=7)),
+            ('get_issue_', datetime.timedelta(days=30), datetime.timedelta(days=90)),
+            ('issue_locations', datetime.timedelta(days=90), None)
+            ]
 
     def __init__(self, username=None):
         self.username = username
         self.cache = DummyCache()
+        self.pool_size = DEFAULT_POOL_SIZE
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """ Gets the pooled HTTP session used for all requests
+            to this service.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = ServiceSession(self.pool_size)
+        return self._session
+
+    def set_cache(self, cache):
+        for prefix, lifetime, stale_lifetime in self.cache_policies:
+            cache.set_policy(prefix, lifetime, stale_lifetime)
+        self.cache = cache
+
+    def set_pool_size(self, pool_size):
+        if self._session is not None:
+            raise Exception("The connection pool has already been created.")
+        self.pool_size = pool_size
+
+    def set_rate_limit(self, rate):
+        self.session.set_rate_limit(rate)
+
+    def get_connection_stats(self):
+        if self._session is None:
+            return {'requests': 0, 'connections_opened': 0, 'connections_reused': 0}
+        return self._session.get_stats()
 
     def login(self, password):
         """ Logs the user into the service.
@@ -38,20 +80,78 @@ class ServiceAccount(object):
         """
         raise NotImplementedError()
 
-    def get_issue(self, comic_id):
+    def get_issue(self, comic_id, load_all=True):
+        """ Gets an issue by ID, loading as little as possible to find
+            it. Unless `load_all` is set, returns `None` instead of going
+            through the whole collection if it's not where it was last
+            seen.
+        """
         collection = self.get_collection()
-        for s in collection.series:
-            for v in s.volumes:
-                for i in v.issues:
-                    if i.comic_id == comic_id:
-                        return i
-        return None
+        issue = collection.get_issue(comic_id)
+        if issue is not None:
+            return issue
+
+        # Try only loading the volume we last saw that issue in.
+        locations = self.cache.get('issue_locations') or {}
+        if comic_id in locations:
+            series_id, volume_id = locations[comic_id]
+            vol = collection.get_volume(volume_id)
+            if vol is not None:
+                vol.issues
+                issue = collection.get_issue(comic_id)
+                if issue is not None:
+                    return issue
+        if not load_all:
+            return None
+
+        for i in collection.iter_issues():
+            if i.comic_id == comic_id:
+                issue = i
+                break
+        self.update_issue_locations(collection)
+        return issue
+
+    def update_issue_locations(self, collection):
+        """ Remembers where the loaded issues of the given collection
+            are, so that `get_issue` can later find them without
+            loading everything.
+        """
+        locations = dict(self.cache.get('issue_locations') or {})
+        locations.update(collection.get_issue_locations())
+        self.cache.set('issue_locations', locations)
 
     def get_issue_downloader(self, issue, ctx):
         """ Gets a downloader object for the given issue.
         """
         raise NotImplementedError()
 
+    def _get_cached_json(self, key, url, parser=None, **kwargs):
+        """ Gets the JSON response for the given URL through the cache,
+            revalidating with the server's ETag/Last-Modified headers
+            when the cached response has expired. If a `parser` is
+            given, the object it builds from the response is returned,
+            and reused for as long as the response doesn't change.
+        """
+        def _fetch(validators):
+            request_kwargs = dict(kwargs)
+            headers = dict(request_kwargs.pop('headers', None) or {})
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last_modified' in validators:
+                headers['If-Modified-Since'] = validators['last_modified']
+            r = self.session.get(url, headers=headers, **request_kwargs)
+            if r.status_code == 304:
+                return (NOT_MODIFIED, validators)
+            r.raise_for_status()
+            validators = {}
+            if r.headers.get('etag'):
+                validators['etag'] = r.headers['etag']
+            if r.headers.get('last-modified'):
+                validators['last_modified'] = r.headers['last-modified']
+            return (r.json(), validators)
+
+        return self.cache.get_or_fetch(key, _fetch, parser=parser)
+
     @classmethod
     def from_cookie(cls, cookie):
         account = cls()
@@ -1,6 +1,7 @@
 import json
 import os.path
 import thread
+import threading
 from flask import g, redirect, url_for, request, render_template, flash
 from auth import UserAccount, get_service_class
 from cache import Cache, DummyCache
@@ -9,10 +10,29 @@ from clf import app, cache_dir
 
 
 # Globals
-cache = Cache(cache_dir)
+CACHE_SWEEP_INTERVAL = 60 * 60
+# Request caches by service name. They outlive the requests, and are
+# created when first needed so that the CLI commands, which also import
+# this module, don't get caches and sweepers they don't use.
+caches = {}
+caches_lock = threading.Lock()
 active_downloads = {}
 
 
+def get_cache(service_name):
+    with caches_lock:
+        cache = caches.get(service_name)
+        if cache is None:
+            cache = Cache(os.path.join(cache_dir, 'reqs', service_name), serve_stale=True)
+            # In MB, for each service's cache.
+            quota = app.config.get('CACHE_QUOTA')
+            if quota is not None:
+                quota = quota * 1024 * 1024
+            cache.start_sweeper(CACHE_SWEEP_INTERVAL, quota)
+            caches[service_name] = cache
+        return cache
+
+
 # Request pre/post-processors
 @app.before_request
 def before_request():
@@ -24,9 +44,9 @@ def before_request():
         g.account = ua
 
     if request.args.get('nocache', False):
-        g.account.set_caches(DummyCache())
+        g.account.set_caches(dict((n, DummyCache()) for n in g.account.services))
     else:
-        g.account.set_caches(cache)
+        g.account.set_caches(dict((n, get_cache(n)) for n in g.account.services))
 
 
 # Views
@@ -60,9 +80,8 @@ def series(service_name, series_id):
     lib = CbzLibrary(g.account.library_path)
     for issue in series:
         issue.series_title = series_info.title # Patch missing series_title from Comixology
-        path = lib.get_issue_path(issue)
-        issue.path = path
-        if os.path.isfile(path):
+        issue.path = lib.get_issue_path(issue)
+        if lib.has_issue(issue, service.service_name):
             issue.downloaded = True
 
         issue.small_cover_url = service.cdn.get_resized(issue.cover_url, 170, 170)
@@ -113,6 +132,12 @@ def downloads():
     return json.dumps(active_downloads)
 
 
+@app.route('/cache/stats')
+def cache_stats():
+    with caches_lock:
+        return json.dumps(dict((n, c.get_stats()) for n, c in caches.iteritems()))
+
+
 @app.route('/settings', methods = ['GET', 'POST'])
 def settings():
     if request.method == 'POST':
@@ -158,10 +183,7 @@ def service_login(service_name, next=''):
 
 # Utility functions
 def find_series_in_collection(collection, series_id):
-    for series in collection:
-        if series.series_id == series_id:
-            return series
-    return None
+    return collection.get_series(series_id)
 
 def do_download(service_name, comic_id, account):
     service = account.services[service_name]